@@ -0,0 +1,138 @@
+# benchmarks/bench_handlers.py
+# Mide los handlers de extremo a extremo contra una hoja y un bot falsos (ver fakes.py):
+# latencia por operación (p50/p95/p99) y throughput con varias peticiones en paralelo.
+# Uso: python benchmarks/bench_handlers.py [--rows 1000,10000,100000,1000000] [--ops 200]
+#        [--concurrency 8] [--sheet-latency 0.2] [--bot-latency 0.05]
+# Cada tamaño se ejecuta en un proceso aparte para que cachés e índices empiecen en frío.
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+
+import fakes
+from fakes import bot_pro
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+def report(label, latencies, wall, unit="op"):
+    lat = sorted(latencies)
+    ms = [v * 1000 for v in (percentile(lat, 0.5), percentile(lat, 0.95), percentile(lat, 0.99), lat[-1])]
+    print(
+        f"  {label:<32} p50 {ms[0]:>8.2f} ms  p95 {ms[1]:>8.2f} ms  p99 {ms[2]:>8.2f} ms  "
+        f"max {ms[3]:>8.2f} ms  {len(lat) / wall:>9.1f} {unit}/s"
+    )
+
+async def run(label, ops, concurrency, make_op, unit="op"):
+    # make_op(i) -> corrutina de una operación; concurrency trabajadores comparten los ops
+    latencies = []
+    counter = iter(range(ops))
+
+    async def worker():
+        for i in counter:
+            t0 = time.perf_counter()
+            await make_op(i)
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    report(label, latencies, time.perf_counter() - t0, unit)
+
+SELL_STEPS = [
+    (bot_pro.c_city, "Valencia"),
+    (bot_pro.c_price, "139000"),
+    (bot_pro.c_m2, "80"),
+    (bot_pro.c_rent, "750"),
+    (bot_pro.c_state, "Reformado"),
+    (bot_pro.c_url, "https://example.com/piso/nuevo"),
+    (bot_pro.c_photo, "no"),
+    (bot_pro.c_contact, "600000000"),
+    (bot_pro.c_confirm, "si"),
+]
+
+async def sell_flow(bot, user_id):
+    context = fakes.fake_context(bot)
+    for handler, text in SELL_STEPS:
+        await handler(fakes.fake_update(bot, user_id, text), context)
+
+async def bench(rows, ops, concurrency, sheet_latency, bot_latency):
+    print(f"{rows} filas · {ops} ops · concurrencia {concurrency} · latencia hoja {sheet_latency * 1000:.0f} ms · bot {bot_latency * 1000:.0f} ms")
+    values = fakes.fake_values(rows)
+    ws = fakes.FakeWorksheet(values, sheet_latency)
+    bot = fakes.FakeBot(bot_latency)
+    await fakes.install(ws, bot)
+    rnd = random.Random(1)
+    try:
+        # parse_listing_row, en bloques de 1000 filas (una sola fila es demasiado rápida para medirla)
+        sample = values[1:min(len(values), 100_001)]
+        chunks = [sample[i:i + 1000] for i in range(0, len(sample), 1000)]
+        lat, t0 = [], time.perf_counter()
+        for chunk in chunks:
+            t1 = time.perf_counter()
+            for r in chunk:
+                bot_pro.parse_listing_row(r)
+            lat.append(time.perf_counter() - t1)
+        report("parse_listing_row ×1000", lat, time.perf_counter() - t0, "bloques")
+
+        # Carga completa del snapshot (primera petición tras arrancar o invalidar)
+        async def cold(_):
+            bot_pro.LISTINGS.invalidate()
+            await bot_pro.LISTINGS.get()
+        await run("carga completa de la caché", 3, 1, cold)
+
+        ctx = fakes.fake_context(bot)
+        await run("send_listings_sorted (yield)", ops, concurrency,
+                  lambda i: bot_pro.send_listings_sorted(ctx, 1000 + i, "yield"))
+        await run("send_listings_sorted (precio)", ops, concurrency,
+                  lambda i: bot_pro.send_listings_sorted(ctx, 1000 + i, "price"))
+
+        queries = [c.lower() for c in fakes.CITIES] + ["malaga", "valenca", "sevila", "zaragosa", "atlantis"]
+
+        async def city_search(i):
+            context = fakes.fake_context(bot, {"awaiting_city_search": True})
+            await bot_pro.city_search_message(fakes.fake_update(bot, 1000 + i, rnd.choice(queries)), context)
+        await run("city_search_message", ops, concurrency, city_search)
+
+        admin = bot_pro.ADMIN_IDS[0]
+        await run("admin_list", ops, concurrency,
+                  lambda i: bot_pro.admin_list(fakes.fake_update(bot, admin, "/lista"), ctx))
+
+        export_ctx = fakes.SimpleNamespace(bot=bot, args=["csv"], user_data={})
+        await run("admin_export (csv)", 3, 1,
+                  lambda i: bot_pro.admin_export(fakes.fake_update(bot, admin, "/export"), export_ctx))
+
+        await run("venta completa (9 pasos)", max(1, ops // 4), concurrency,
+                  lambda i: sell_flow(bot, 50_000 + i), "conv")
+    finally:
+        await fakes.uninstall()
+    print(f"  llamadas: hoja {ws.calls} · bot {bot.calls}")
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark de handlers con hoja y bot falsos")
+    p.add_argument("--rows", default="1000,10000,100000,1000000")
+    p.add_argument("--ops", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--sheet-latency", type=float, default=0.2)
+    p.add_argument("--bot-latency", type=float, default=0.05)
+    args = p.parse_args()
+    sizes = [int(s) for s in args.rows.split(",") if s]
+    if len(sizes) == 1:
+        asyncio.run(bench(sizes[0], args.ops, args.concurrency, args.sheet_latency, args.bot_latency))
+        return
+    for n in sizes:
+        subprocess.run([
+            sys.executable, os.path.abspath(__file__), "--rows", str(n), "--ops", str(args.ops),
+            "--concurrency", str(args.concurrency), "--sheet-latency", str(args.sheet_latency),
+            "--bot-latency", str(args.bot_latency),
+        ], check=True)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# benchmarks/bench_listing.py
+# Compara el parseo antiguo (dict de 13 claves por fila, pasando por get_all_records) con
+# Listing (__slots__, construido en una pasada desde los valores de la hoja), y con la lectura de
+# la caché: solo CACHE_FIELDS y números sin formato (batch_get con UNFORMATTED_VALUE).
+# Uso: python benchmarks/bench_listing.py [filas]
+
+import os
+import sys
+import time
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+from bot_pro import SHEET_HEADER, Listing, SheetProjection, safe_float  # noqa: E402
+
+CITIES = ["Madrid", "Valencia", "Málaga", "Sevilla", "Zaragoza", "Bilbao", "Alicante", "Murcia"]
+
+def fake_values(n):
+    rnd = random.Random(42)
+    rows = [list(SHEET_HEADER)]
+    for i in range(n):
+        rows.append([
+            f"2024-01-01T00:00:{i % 60:02d}",
+            str(100000 + i),
+            f"user{i}",
+            rnd.choice(CITIES),
+            str(rnd.randrange(40000, 400000, 1000)),
+            str(rnd.randrange(30, 150)),
+            str(rnd.randrange(300, 1500, 10)),
+            rnd.choice(["Reformado", "A reformar"]),
+            f"https://example.com/piso/{i}",
+            "",
+            "",
+            "600000000",
+        ])
+    return rows
+
+def legacy_parse(r):
+    # parse_listing_row antes de Listing: record dict -> lista posicional -> dict
+    row = [
+        r.get("timestamp", ""), r.get("chat_id", ""), r.get("user", ""), r.get("city", ""),
+        r.get("price", ""), r.get("m2", ""), r.get("rent_est", ""), r.get("state", ""),
+        r.get("url", ""), r.get("notes", ""), r.get("photo_filename", ""), r.get("contact", ""),
+    ]
+    data = {}
+    for i, key in enumerate(["timestamp", "chat_id", "user", "city"]):
+        data[key] = row[i]
+    data["price"] = safe_float(row[4])
+    data["m2"] = safe_float(row[5])
+    data["rent_est"] = safe_float(row[6])
+    for i, key in zip(range(7, 12), ["state", "url", "notes", "photo", "contact"]):
+        data[key] = row[i]
+    if data["price"] and data["rent_est"]:
+        data["yield"] = round((data["rent_est"] * 12) / data["price"] * 100, 2)
+    else:
+        data["yield"] = None
+    return data
+
+def measure(label, fn):
+    # Tiempo y memoria en pasadas separadas: tracemalloc encarece cada reserva y falsearía el tiempo.
+    # El tiempo es la mejor de 5 pasadas, para que el ruido de la máquina no decida la comparación.
+    elapsed = float("inf")
+    for _ in range(5):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = min(elapsed, time.perf_counter() - t0)
+    tracemalloc.start()
+    result = fn()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<28} {elapsed * 1000:>9.1f} ms {size / 1024 / 1024:>9.1f} MiB {len(result):>9d} filas")
+    return result
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    values = fake_values(n)
+    header, rows = values[0], values[1:]
+    records = [dict(zip(header, r)) for r in rows]
+    print(f"{n} filas")
+    measure("dict por fila (antes)", lambda: [legacy_parse(r) for r in records])
+    measure("Listing.from_row", lambda: [Listing.from_row(r) for r in rows])
+    proj = SheetProjection(header)
+    numeric = {SHEET_HEADER.index(name) for name in ("price", "m2", "rent_est")}
+    parts = [
+        [[int(r[c]) if c in numeric else r[c] for c in range(a, b + 1)] for r in rows]
+        for a, b in proj.spans
+    ]
+    measure("SheetProjection.parse", lambda: proj.parse(parts))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# benchmarks/fakes.py
+# Sustitutos en memoria de la hoja de gspread y de context.bot, para medir el bot sin Google
+# Sheets ni token reales. La latencia artificial se configura por llamada (en segundos).
+#
+# Importar este módulo ANTES que bot_pro: fija las variables de entorno para que los datos
+# locales vayan a un directorio temporal y el limitador de envíos no domine las medidas.
+
+import os
+import re
+import sys
+import time
+import random
+import asyncio
+import tempfile
+import itertools
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="r2r-bench-"))
+os.environ.setdefault("STORAGE_BACKEND", "sheets")
+os.environ.setdefault("ADMIN_IDS", "1")
+os.environ.setdefault("ADMIN_NOTIFY", "1")
+os.environ.setdefault("SEND_RATE_GLOBAL", "1000000")
+os.environ.setdefault("SEND_RATE_CHAT", "1000000")
+os.environ.setdefault("SEND_RATE_GROUP", "1000000")
+os.environ.setdefault("SEND_BURST_CHAT", "1000000")
+os.environ.setdefault("HEALTH_PORT", "0")
+
+import bot_pro  # noqa: E402
+
+bot_pro.logger.setLevel("WARNING")
+
+CITIES = ["Madrid", "Valencia", "Málaga", "Sevilla", "Zaragoza", "Bilbao", "Alicante", "Murcia"]
+
+def fake_values(n, seed=42):
+    # header + n filas con el contenido de las celdas: números como números y el resto como texto,
+    # igual que los guarda la hoja. Los valores repetidos se comparten entre filas para que 1M de
+    # filas quepa en memoria sin que eso cambie lo que se mide.
+    rnd = random.Random(seed)
+    prices = list(range(40000, 400000, 1000))
+    m2s = list(range(30, 150))
+    rents = list(range(300, 1500, 10))
+    stamps = [f"2024-01-01T00:00:{s:02d}" for s in range(60)]
+    states = ["Reformado", "A reformar"]
+    rows = [list(bot_pro.SHEET_HEADER)]
+    for i in range(n):
+        rows.append([
+            stamps[i % 60],
+            "100000",
+            "user",
+            rnd.choice(CITIES),
+            rnd.choice(prices),
+            rnd.choice(m2s),
+            rnd.choice(rents),
+            rnd.choice(states),
+            "https://example.com/piso",
+            "",
+            "",
+            "600000000",
+        ])
+    return rows
+
+def formatted(row):
+    # Lo que devuelve la API con FORMATTED_VALUE: todo texto
+    return [c if isinstance(c, str) else bot_pro.fmt_num(c) for c in row]
+
+def column_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n - 1
+
+class FakeWorksheet:
+    # Lo que el bot usa de gspread.Worksheet, sobre una lista de filas en memoria
+    title = "fake"
+
+    def __init__(self, values, latency=0.0):
+        self.values = values
+        self.latency = latency
+        self.calls = 0
+
+    def _wait(self):
+        # Se ejecuta en el pool de hilos de SheetStorage, igual que una petición HTTP real
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_all_values(self):
+        self._wait()
+        return [formatted(r) for r in self.values]
+
+    def get_all_records(self):
+        self._wait()
+        header = self.values[0]
+        return [dict(zip(header, r)) for r in self.values[1:]]
+
+    def row_values(self, row):
+        self._wait()
+        return formatted(self.values[row - 1]) if row <= len(self.values) else []
+
+    def get(self, range_name):
+        # "A2:L" (hasta el final) o "A2:L5001"; las columnas no se recortan
+        self._wait()
+        m = re.match(r"[A-Z]+(\d+)(?::[A-Z]+(\d+)?)?", range_name)
+        first = int(m.group(1)) if m else 1
+        last = int(m.group(2)) if m and m.group(2) else len(self.values)
+        return [formatted(r) for r in self.values[first - 1:last]]
+
+    def batch_get(self, ranges, value_render_option=None, **kwargs):
+        # "1:1", "C2:I" o "C2:I5001". Como la API, sin celdas vacías al final de cada fila ni
+        # filas vacías al final del rango
+        self._wait()
+        raw = value_render_option == "UNFORMATTED_VALUE"
+        out = []
+        for rng in ranges:
+            m = re.match(r"([A-Z]*)(\d*):([A-Z]*)(\d*)$", rng)
+            c0, r0, c1, r1 = m.groups()
+            first, last = column_index(c0) if c0 else 0, column_index(c1) + 1 if c1 else None
+            rows = []
+            for r in self.values[int(r0 or 1) - 1:int(r1) if r1 else len(self.values)]:
+                cells = list(r[first:last]) if raw else formatted(r[first:last])
+                while cells and cells[-1] == "":
+                    cells.pop()
+                rows.append(cells)
+            while rows and not rows[-1]:
+                rows.pop()
+            out.append(rows)
+        return out
+
+    def col_values(self, col):
+        self._wait()
+        return [r[col - 1] for r in self.values if len(r) >= col and r[col - 1] != ""]
+
+    def insert_row(self, row, index=1):
+        self._wait()
+        self.values.insert(index - 1, list(row))
+
+    def append_rows(self, rows, **kwargs):
+        self._wait()
+        first = len(self.values) + 1
+        self.values.extend(list(r) for r in rows)
+        return {"updates": {"updatedRange": f"Sheet1!A{first}:L{len(self.values)}"}}
+
+    def append_row(self, row, **kwargs):
+        return self.append_rows([row], **kwargs)
+
+class FakeBot:
+    # context.bot: cada método espera la latencia configurada y devuelve un mensaje mínimo
+    username = "r2r_bench_bot"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._ids = itertools.count(1)
+
+    async def _call(self, chat_id, text=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return SimpleNamespace(message_id=next(self._ids), chat=SimpleNamespace(id=chat_id), text=text)
+
+    async def get_me(self):
+        await self._call(None)
+        return SimpleNamespace(username=self.username, id=0)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._call(chat_id, text)
+
+    async def send_media_group(self, chat_id, media=None, **kwargs):
+        return [await self._call(chat_id)]
+
+    async def send_document(self, chat_id, document=None, **kwargs):
+        return await self._call(chat_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return await self._call(chat_id, text)
+
+class FakeMessage:
+    def __init__(self, bot, chat, text="", photo=()):
+        self._bot = bot
+        self.chat = chat
+        self.text = text
+        self.photo = list(photo)
+        self.message_id = 0
+        self.new_chat_members = []
+
+    async def reply_text(self, text, **kwargs):
+        kwargs.pop("reply_to_message_id", None)
+        return await self._bot.send_message(self.chat.id, text, **kwargs)
+
+def fake_update(bot, user_id, text="", chat_type="private"):
+    # Update con lo que leen los handlers: message, effective_chat y effective_user
+    chat = SimpleNamespace(id=user_id, type=chat_type)
+    user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Bench", full_name=f"Bench {user_id}")
+    message = FakeMessage(bot, chat, text)
+    return SimpleNamespace(message=message, effective_chat=chat, effective_user=user, effective_message=message, callback_query=None)
+
+def fake_context(bot, user_data=None):
+    return SimpleNamespace(bot=bot, user_data={} if user_data is None else user_data, chat_data={}, bot_data={})
+
+async def install(ws, bot):
+    # Conecta bot_pro a los sustitutos y arranca lo que en producción arranca post_init
+    bot_pro.SHEETS._ws = ws
+    bot_pro.SHEETS._header_checked = True
+    bot_pro.OUTBOX.start(bot)
+    await bot_pro.warm_up(SimpleNamespace(bot=bot))
+
+async def uninstall():
+    await bot_pro.STORE.stop()
+    await bot_pro.OUTBOX.stop()
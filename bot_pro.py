@@ -1,20 +1,51 @@
 # bot_pro.py
 # Ready2Rent - Bot PRO (con menú: Busco / Vendo / Manuales / Contacto)
 # Requisitos:
-# pip install python-telegram-bot==20.3 gspread oauth2client
+# pip install "python-telegram-bot[webhooks]==20.3" gspread oauth2client numpy
+# (numpy: recálculo vectorizado de /mercado; sin él se usa el cálculo en Python puro, más lento)
+# Opcional: pip install Pillow  (miniaturas de las fotos)
 
 import os
+import json
+import asyncio
+import re
+import time
+import sys
+import functools
+import traceback
+import hashlib
+import importlib.util
+import collections
+import random
+import bisect
+import array
+import itertools
+import operator
+import csv
+import io
+import tempfile
+import sqlite3
 import logging
+import threading
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any
+from urllib.parse import parse_qsl, urlencode
+from typing import List, Dict, Any, Optional
+
+_IMPORT_T0 = time.perf_counter()
 
 from telegram import (
     Update,
+    InputFile,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
 )
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -22,10 +53,12 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
+    BasePersistence,
+    PersistenceInput,
 )
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+# gspread, oauth2client y requests se importan al conectar con la hoja (ver gsheet_client):
+# son lo más lento del arranque y el modo solo-SQLite puede no necesitarlos.
 
 # ----------------------------
 # CONFIG desde VARIABLES DE ENTORNO
@@ -37,6 +70,57 @@ SHEET_NAME = os.environ.get("SHEET_NAME", "R2R_Listings")
 SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID")  # recomendado
 GOOGLE_CREDS_JSON = os.environ.get("GOOGLE_CREDS_JSON")
 SAMPLE_PDF_URL = os.environ.get("SAMPLE_PDF_URL", "https://example.com/calculadora_rentabilidad.pdf")
+SHEETS_MAX_CONCURRENCY = int(os.environ.get("SHEETS_MAX_CONCURRENCY", "4"))  # llamadas simultáneas a Sheets
+SHEETS_TIMEOUT = float(os.environ.get("SHEETS_TIMEOUT", "20"))  # segundos por llamada
+SHEETS_RETRIES = int(os.environ.get("SHEETS_RETRIES", "2"))  # reintentos de lecturas ante 429/5xx/red
+SHEETS_BACKOFF = float(os.environ.get("SHEETS_BACKOFF", "0.5"))  # base del backoff exponencial (s)
+SHEETS_BACKOFF_MAX = float(os.environ.get("SHEETS_BACKOFF_MAX", "8"))
+SHEETS_BREAKER_FAILURES = int(os.environ.get("SHEETS_BREAKER_FAILURES", "3"))  # fallos seguidos que abren el circuito
+SHEETS_BREAKER_COOLDOWN = float(os.environ.get("SHEETS_BREAKER_COOLDOWN", "10"))  # segundos abierto la primera vez
+SHEETS_BREAKER_MAX_COOLDOWN = float(os.environ.get("SHEETS_BREAKER_MAX_COOLDOWN", "300"))
+LISTINGS_TTL = float(os.environ.get("LISTINGS_TTL", "60"))  # segundos que se sirve la caché sin mirar la hoja
+LISTINGS_FULL_RELOAD = float(os.environ.get("LISTINGS_FULL_RELOAD", "900"))  # recarga completa (ediciones a mano)
+DATA_DIR = os.environ.get("DATA_DIR", "./data")
+DB_PATH = os.environ.get("DB_PATH", os.path.join(DATA_DIR, "r2r.sqlite3"))
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", "5"))  # segundos entre volcados del diario a la hoja
+FLUSH_BATCH = int(os.environ.get("FLUSH_BATCH", "50"))  # filas por append_rows
+FLUSH_MAX_BACKOFF = float(os.environ.get("FLUSH_MAX_BACKOFF", "300"))
+# Fallos achacables a la propia fila (no a una caída de la hoja) antes de apartarla del diario
+FLUSH_MAX_ATTEMPTS = int(os.environ.get("FLUSH_MAX_ATTEMPTS", "5"))
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sheets").lower()  # sheets | sqlite
+# Con STORAGE_BACKEND=sqlite, la hoja queda como espejo opcional (por defecto si hay credenciales)
+SHEETS_MIRROR = os.environ.get("SHEETS_MIRROR", "1" if GOOGLE_CREDS_JSON else "0") == "1"
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", "8"))  # envíos simultáneos a Telegram
+SEND_RATE_GLOBAL = float(os.environ.get("SEND_RATE_GLOBAL", "25"))  # msg/s en total (límite Telegram ~30)
+SEND_RATE_CHAT = float(os.environ.get("SEND_RATE_CHAT", "1"))  # msg/s sostenidos por chat privado
+SEND_RATE_GROUP = float(os.environ.get("SEND_RATE_GROUP", "0.33"))  # msg/s por grupo (límite Telegram 20/min)
+SEND_BURST_CHAT = int(os.environ.get("SEND_BURST_CHAT", "5"))  # ráfaga permitida por chat
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", "5"))
+CITY_REPLY_TTL = float(os.environ.get("CITY_REPLY_TTL", "10"))  # segundos que se reutiliza la respuesta a /<ciudad>
+PHOTO_DIR = os.environ.get("PHOTO_DIR", "./uploads")
+PHOTO_WORKERS = int(os.environ.get("PHOTO_WORKERS", "2"))  # descargas de fotos en paralelo
+PHOTO_VARIANT_PROCS = int(os.environ.get("PHOTO_VARIANT_PROCS", "1"))  # procesos para miniaturas (requiere Pillow)
+ERROR_DIGEST_INTERVAL = float(os.environ.get("ERROR_DIGEST_INTERVAL", "300"))  # segundos entre resúmenes de errores
+ERROR_DIGEST_SAMPLES = int(os.environ.get("ERROR_DIGEST_SAMPLES", "1"))  # tracebacks de ejemplo por grupo
+# Modo webhook: se activa definiendo WEBHOOK_URL (URL pública https, sin el path)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # se comprueba en la cabecera X-Telegram-Bot-Api-Secret-Token
+PERSISTENCE = os.environ.get("PERSISTENCE", "1") == "1"  # conversaciones y user_data sobreviven a reinicios
+PERSIST_INTERVAL = float(os.environ.get("PERSIST_INTERVAL", "5"))  # cada cuánto PTB entrega los cambios
+PERSIST_DEBOUNCE = float(os.environ.get("PERSIST_DEBOUNCE", "0.5"))  # agrupa los cambios en una transacción
+EXPORT_CHUNK = int(os.environ.get("EXPORT_CHUNK", "5000"))  # filas por lectura al exportar
+EXPORT_SPOOL = int(os.environ.get("EXPORT_SPOOL", str(8 * 1024 * 1024)))  # bytes en memoria antes de pasar a disco
+ALERTS_PER_USER = int(os.environ.get("ALERTS_PER_USER", "10"))  # búsquedas guardadas por usuario
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "32"))  # updates procesados a la vez (1 = secuencial)
+UPDATE_BACKLOG = int(os.environ.get("UPDATE_BACKLOG", "4096"))  # updates en curso, contando los que esperan turno
+# Endpoints de salud (GET /healthz) y métricas (GET /metrics); por defecto activo en modo webhook
+HEALTH_PORT = int(os.environ.get("HEALTH_PORT", "8081" if WEBHOOK_URL else "0"))
+# Solo local por defecto: /metrics expone contadores por handler y detalles de errores. Para que un
+# balanceador externo consulte /healthz hay que abrirlo a propósito (p. ej. HEALTH_LISTEN=0.0.0.0).
+HEALTH_LISTEN = os.environ.get("HEALTH_LISTEN", "127.0.0.1")
 
 if not BOT_TOKEN:
     raise Exception("BOT_TOKEN missing in env")
@@ -45,31 +129,181 @@ if not BOT_TOKEN:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("r2r-bot")
 
+# ----------------------------
+# Métricas (formato texto de Prometheus en /metrics y resumen en /stats)
+# ----------------------------
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *labelvalues, amount: float = 1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in self.values.items()]
+        return out
+
+class Histogram:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values: Dict[tuple, List[float]] = {}  # labels -> [n por bucket..., +Inf, suma]
+
+    def observe(self, value: float, *labelvalues):
+        v = self.values.get(labelvalues)
+        if v is None:
+            v = self.values[labelvalues] = [0] * (len(self.buckets) + 2)
+        v[bisect.bisect_left(self.buckets, value)] += 1
+        v[-1] += value
+
+    def quantile(self, q: float, *labelvalues):
+        # Estimación por interpolación lineal dentro del bucket, como histogram_quantile()
+        v = self.values.get(labelvalues)
+        if not v:
+            return None
+        counts = v[:-1]
+        rank = q * sum(counts)
+        seen = 0
+        for i, c in enumerate(counts):
+            if c and seen + c >= rank:
+                lo = self.buckets[i - 1] if i > 0 else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for k, v in self.values.items():
+            acc = 0
+            for b, c in zip(self.buckets + ("+Inf",), v[:-1]):
+                acc += c
+                out.append(f"{self.name}_bucket{_labels(self.labels + ('le',), k + (b,))} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labels, k)} {v[-1]}")
+            out.append(f"{self.name}_count{_labels(self.labels, k)} {acc}")
+        return out
+
+class Gauge:
+    # El valor se lee al exportar (profundidad de colas, etc.): coste cero en el camino caliente
+    def __init__(self, name: str, help_text: str, fn):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v).replace(chr(34), chr(39))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Metrics:
+    def __init__(self):
+        self.all: List[Any] = []
+
+    def counter(self, name: str, help_text: str, labels=()) -> Counter:
+        m = Counter(name, help_text, labels)
+        self.all.append(m)
+        return m
+
+    def histogram(self, name: str, help_text: str, labels=()) -> Histogram:
+        m = Histogram(name, help_text, labels)
+        self.all.append(m)
+        return m
+
+    def gauge(self, name: str, help_text: str, fn) -> Gauge:
+        m = Gauge(name, help_text, fn)
+        self.all.append(m)
+        return m
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self.all:
+            lines += m.render()
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+M_HANDLER_SECONDS = METRICS.histogram("r2r_handler_seconds", "Duración de cada handler", ("handler",))
+M_HANDLER_ERRORS = METRICS.counter("r2r_handler_errors_total", "Excepciones por handler", ("handler",))
+M_SHEETS_CALLS = METRICS.counter("r2r_sheets_calls_total", "Llamadas a Google Sheets", ("op", "result"))
+M_SHEETS_SECONDS = METRICS.histogram("r2r_sheets_seconds", "Latencia de Google Sheets", ("op",))
+M_SHEETS_BYTES = METRICS.counter("r2r_sheets_bytes_total", "Bytes recibidos de Google Sheets")
+M_SHEETS_RETRIES = METRICS.counter("r2r_sheets_retries_total", "Reintentos de llamadas a Google Sheets", ("op",))
+M_CACHE = METRICS.counter("r2r_listings_cache_total", "Lecturas de la caché de anuncios", ("result",))
+M_TG_SECONDS = METRICS.histogram("r2r_telegram_send_seconds", "Latencia de envíos a Telegram", ("method",))
+M_TG_RETRIES = METRICS.counter("r2r_telegram_retries_total", "Reintentos de envíos a Telegram", ("reason",))
+M_TG_ERRORS = METRICS.counter("r2r_telegram_errors_total", "Envíos a Telegram fallidos", ("error",))
+
+def timed(fn):
+    # Latencia y errores por handler
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def _timed(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            M_HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            M_HANDLER_SECONDS.observe(time.perf_counter() - t0, name)
+    return _timed
+
 # ----------------------------
 # Google Sheets helpers
 # ----------------------------
-def gsheet_client():
+SHEET_HEADER = [
+    "timestamp",
+    "chat_id",
+    "user",
+    "city",
+    "price",
+    "m2",
+    "rent_est",
+    "state",
+    "url",
+    "notes",
+    "photo_filename",
+    "contact",
+]
+
+def gsheet_credentials():
     if not GOOGLE_CREDS_JSON:
         raise Exception("GOOGLE_CREDS_JSON missing in env")
-    if GOOGLE_CREDS_JSON.strip().startswith("{"):
-        tmp_path = "/tmp/gcreds.json"
-        with open(tmp_path, "w") as f:
-            f.write(GOOGLE_CREDS_JSON)
-        creds_path = tmp_path
-    else:
-        creds_path = GOOGLE_CREDS_JSON
+    from oauth2client.service_account import ServiceAccountCredentials
     scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(creds_path, scope)
-    client = gspread.authorize(creds)
-    return client
+    # JSON en la variable: lo cargamos en memoria, sin reescribir /tmp/gcreds.json en cada llamada
+    if GOOGLE_CREDS_JSON.strip().startswith("{"):
+        return ServiceAccountCredentials.from_json_keyfile_dict(json.loads(GOOGLE_CREDS_JSON), scope)
+    return ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDS_JSON, scope)
 
-def ensure_sheet():
-    client = gsheet_client()
+def gsheet_client():
+    import gspread
+    return gspread.authorize(gsheet_credentials())
+
+def open_spreadsheet(client):
     try:
         if SPREADSHEET_ID:
-            sh = client.open_by_key(SPREADSHEET_ID)
-        else:
-            sh = client.open(SHEET_NAME)
+            return client.open_by_key(SPREADSHEET_ID)
+        return client.open(SHEET_NAME)
     except Exception as e:
         logger.exception("Error abriendo la hoja en Google Sheets")
         raise Exception(
@@ -77,31 +311,314 @@ def ensure_sheet():
             "Crea la hoja y compártela con el client_email de la service account, "
             "o define SPREADSHEET_ID."
         ) from e
-    ws = sh.sheet1
-    header = [
-        "timestamp",
-        "chat_id",
-        "user",
-        "city",
-        "price",
-        "m2",
-        "rent_est",
-        "state",
-        "url",
-        "notes",
-        "photo_filename",
-        "contact",
-    ]
+
+def ensure_header(ws):
     try:
         first_row = ws.row_values(1)
     except Exception:
         first_row = []
     if not first_row:
         try:
-            ws.insert_row(header, 1)
+            ws.insert_row(SHEET_HEADER, 1)
         except Exception:
             logger.warning("No se pudo insertar header (posible falta de permisos).")
-    return ws
+
+@functools.lru_cache(maxsize=None)
+def sheets_error_types():
+    # (errores de autenticación, errores tras los que reconectar). Se resuelve en el primer fallo,
+    # que siempre llega después de haber intentado conectar, así que no adelanta ningún import.
+    import requests
+    from oauth2client.client import AccessTokenRefreshError
+    auth = (AccessTokenRefreshError,)
+    try:
+        from google.auth.exceptions import RefreshError, TransportError
+        auth += (RefreshError,)
+        reconnect = (TransportError,)
+    except ImportError:  # gspread antiguo sin google-auth
+        reconnect = ()
+    reconnect += auth + (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        ConnectionError,
+        TimeoutError,
+    )
+    return auth, reconnect
+
+def api_status(exc: BaseException):
+    # Sin gspread cargado no puede haber un APIError: no se importa solo para comprobarlo
+    gspread = sys.modules.get("gspread")
+    if gspread is not None and isinstance(exc, gspread.exceptions.APIError):
+        return getattr(getattr(exc, "response", None), "status_code", None)
+    return None
+
+def is_auth_error(exc: BaseException) -> bool:
+    return api_status(exc) == 401 or isinstance(exc, sheets_error_types()[0])
+
+def is_reconnect_error(exc: BaseException) -> bool:
+    # Errores tras los que merece la pena rehacer la conexión: token caducado/revocado o fallo de red
+    return is_auth_error(exc) or isinstance(exc, sheets_error_types()[1])
+
+def is_transient_error(exc: BaseException) -> bool:
+    # Cuota agotada (429), error del servidor (5xx), timeout o fallo de red: puede ir bien más tarde.
+    # open_spreadsheet envuelve el error original, así que también se mira la causa.
+    while exc is not None:
+        status = api_status(exc)
+        if status is not None:
+            return status == 429 or status >= 500
+        if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+            return True
+        if isinstance(exc, sheets_error_types()[1]) and not is_auth_error(exc):
+            return True
+        exc = exc.__cause__
+    return False
+
+def retry_after(exc: BaseException):
+    # Segundos de la cabecera Retry-After de un 429, si la trae
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+class SheetsUnavailable(Exception):
+    # El circuito está abierto: la llamada ni siquiera se intenta
+    pass
+
+class CircuitBreaker:
+    # closed: las llamadas pasan y se cuentan los fallos seguidos; al llegar a `threshold` se abre.
+    # open: todo falla al momento con SheetsUnavailable durante el cooldown, que se dobla en cada
+    # reapertura seguida (hasta max_cooldown) y lleva jitter para no sincronizar reintentos.
+    # half_open: pasado el cooldown se deja pasar una sola llamada de prueba; si va bien se cierra,
+    # si falla se vuelve a abrir. on_change(state, exc) avisa de cada cambio de estado.
+    STATES = ("closed", "half_open", "open")
+
+    def __init__(self, threshold: int, cooldown: float, max_cooldown: float, on_change=None):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.on_change = on_change
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0  # aperturas seguidas sin cerrarse entre medias
+        self.open_until = 0.0
+        self._probing = False
+
+    def retry_in(self) -> float:
+        # Segundos hasta que se vuelva a probar la hoja (0 si el circuito está cerrado)
+        return 0.0 if self.state == "closed" else max(0.0, self.open_until - time.monotonic())
+
+    def allow(self):
+        if self.state == "closed":
+            return
+        if self.state == "open":
+            if time.monotonic() < self.open_until:
+                raise SheetsUnavailable(f"Google Sheets no disponible; se reintenta en {self.retry_in():.0f}s")
+            self._set("half_open")
+        if self._probing:
+            raise SheetsUnavailable("Google Sheets no disponible; comprobando si se ha recuperado")
+        self._probing = True
+
+    def release(self):
+        # La llamada de prueba se canceló sin resultado: que la siguiente vuelva a probar
+        self._probing = False
+
+    def success(self):
+        self.failures = 0
+        self._probing = False
+        if self.state != "closed":
+            self.opened = 0
+            self._set("closed")
+
+    def failure(self, exc: BaseException):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+            self.opened += 1
+            delay = min(self.cooldown * 2 ** (self.opened - 1), self.max_cooldown) * random.uniform(0.8, 1.2)
+            self.open_until = time.monotonic() + delay
+            self._set("open", exc)
+
+    def _set(self, state: str, exc: BaseException = None):
+        previous, self.state = self.state, state
+        if self.on_change is not None and previous != state:
+            self.on_change(state, exc)
+
+def sheets_circuit_changed(state: str, exc: BaseException = None):
+    # Un único aviso por caída y otro al recuperarse, en vez de un traceback por petición
+    if state == "open" and SHEET_STORAGE.breaker.opened == 1:
+        logger.warning("Google Sheets no responde (%s): circuito abierto, se sirve la caché", exc)
+        notify_admins(f"⚠️ Google Sheets no responde ({type(exc).__name__}). Sirviendo datos en caché; los envíos quedan en el diario.")
+    elif state == "closed":
+        logger.info("Google Sheets responde de nuevo: circuito cerrado")
+        notify_admins("✅ Google Sheets responde de nuevo.")
+
+class SheetConnection:
+    # Cliente gspread único por proceso. Se autoriza y abre la hoja una sola vez; la sesión
+    # autorizada de google-auth renueva el token sola. Solo se reconecta tras un error de
+    # autenticación o de transporte, y el header se comprueba únicamente en la primera conexión.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._ws = None
+        self._header_checked = False
+
+    def worksheet(self):
+        ws = self._ws
+        if ws is not None:
+            return ws
+        with self._lock:
+            if self._ws is None:
+                self._connect()
+            return self._ws
+
+    def reset(self):
+        with self._lock:
+            self._client = None
+            self._ws = None
+
+    def call(self, fn, idempotent: bool = True):
+        # fn recibe el worksheet. Las escrituras no idempotentes solo se reintentan si el fallo
+        # fue de autenticación (la petición no llegó a aplicarse).
+        try:
+            return fn(self.worksheet())
+        except Exception as e:
+            if not is_reconnect_error(e):
+                raise
+            logger.warning("Conexión con Google Sheets perdida (%s). Reconectando...", e)
+            self.reset()
+            if not idempotent and not is_auth_error(e):
+                raise
+            return fn(self.worksheet())
+
+    def _connect(self):
+        client = gsheet_client()
+        session = getattr(getattr(client, "http_client", client), "session", None)
+        if session is not None:
+            session.hooks["response"].append(_count_sheets_bytes)
+        ws = open_spreadsheet(client).sheet1
+        if not self._header_checked:
+            ensure_header(ws)
+            self._header_checked = True
+        self._client = client
+        self._ws = ws
+        logger.info("Conectado a Google Sheets (%s)", ws.title)
+
+def _count_sheets_bytes(response, *args, **kwargs):
+    M_SHEETS_BYTES.inc(amount=len(response.content or b""))
+
+SHEETS = SheetConnection()
+
+class SheetStorage:
+    # Capa async sobre SHEETS: cada llamada bloqueante de gspread se ejecuta en un pool de hilos
+    # acotado, con timeout por llamada, para no congelar el event loop del bot.
+    # El semáforo se libera cuando el hilo termina de verdad (no al vencer el timeout), así una
+    # hoja lenta no acumula trabajo pendiente por encima del límite de concurrencia.
+    # Las lecturas se reintentan ante 429/5xx/red con backoff exponencial y jitter; si los fallos
+    # siguen, el circuit breaker corta las llamadas y fallan al momento con SheetsUnavailable.
+
+    def __init__(self, conn: SheetConnection, max_concurrency: int, timeout: float, breaker: CircuitBreaker,
+                 retries: int = 0, backoff: float = 0.5, max_backoff: float = 8):
+        self.conn = conn
+        self.timeout = timeout
+        self.max_concurrency = max(1, max_concurrency)
+        self.breaker = breaker
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="sheets")
+        self._sem = None
+
+    async def run(self, fn, idempotent: bool = True, timeout: float = None, op: str = "other"):
+        # Las escrituras no idempotentes no se reintentan aquí: lo hace SubmissionQueue con el diario
+        attempt = 0
+        while True:
+            try:
+                return await self._call(fn, idempotent, timeout, op)
+            except SheetsUnavailable:
+                raise
+            except Exception as e:
+                if not (idempotent and attempt < self.retries and is_transient_error(e)):
+                    raise
+                if self.breaker.state != "closed":
+                    raise
+                # Full jitter: espera aleatoria hasta base·2^intento (o lo que pida Retry-After)
+                delay = retry_after(e) or random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                attempt += 1
+                M_SHEETS_RETRIES.inc(op)
+                logger.info("Sheets %s falló (%s); reintento %d en %.1fs", op, type(e).__name__, attempt, delay)
+                await asyncio.sleep(min(delay, self.max_backoff))
+
+    async def _call(self, fn, idempotent: bool, timeout: float, op: str):
+        t0 = time.perf_counter()
+        try:
+            self.breaker.allow()
+            result = await asyncio.wait_for(self._run(fn, idempotent), timeout or self.timeout)
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception as e:
+            M_SHEETS_CALLS.inc(op, type(e).__name__)
+            if isinstance(e, SheetsUnavailable):
+                raise
+            # Un error de la petición (rango inválido, permisos...) no dice que la hoja esté caída
+            if is_transient_error(e) or is_auth_error(e):
+                self.breaker.failure(e)
+            else:
+                self.breaker.success()
+            raise
+        finally:
+            M_SHEETS_SECONDS.observe(time.perf_counter() - t0, op)
+        self.breaker.success()
+        M_SHEETS_CALLS.inc(op, "ok")
+        return result
+
+    async def _run(self, fn, idempotent):
+        loop = asyncio.get_running_loop()
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        sem = self._sem
+        await sem.acquire()
+        try:
+            cf = self._executor.submit(self.conn.call, fn, idempotent)
+        except BaseException:
+            sem.release()
+            raise
+        cf.add_done_callback(lambda _: loop.call_soon_threadsafe(sem.release))
+        return await asyncio.wrap_future(cf, loop=loop)
+
+    async def connect(self):
+        return await self.run(lambda ws: ws, op="open")
+
+    async def append_rows(self, rows):
+        return await self.run(lambda ws: ws.append_rows(rows), idempotent=False, op="append_rows")
+
+    async def get_all_values(self):
+        return await self.run(lambda ws: ws.get_all_values(), op="get_all_values")
+
+    async def batch_get(self, ranges: List[str]):
+        # Varios rangos en una sola petición y con los números sin formato (int/float en vez de
+        # "139.000 €"); las fechas escritas a mano siguen llegando como texto, no como serial
+        return await self.run(
+            lambda ws: ws.batch_get(
+                ranges, value_render_option="UNFORMATTED_VALUE", date_time_render_option="FORMATTED_STRING"
+            ),
+            op="batch_get",
+        )
+
+    async def count_rows(self) -> int:
+        # Filas con algo en la columna A (header incluido): solo se descarga esa columna
+        return await self.run(lambda ws: len(ws.col_values(1)), op="count_rows")
+
+def column_letter(ncols: int) -> str:
+    from gspread.utils import rowcol_to_a1
+    return re.sub(r"\d", "", rowcol_to_a1(1, ncols))
+
+SHEET_STORAGE = SheetStorage(
+    SHEETS, SHEETS_MAX_CONCURRENCY, SHEETS_TIMEOUT,
+    CircuitBreaker(SHEETS_BREAKER_FAILURES, SHEETS_BREAKER_COOLDOWN, SHEETS_BREAKER_MAX_COOLDOWN, sheets_circuit_changed),
+    SHEETS_RETRIES, SHEETS_BACKOFF, SHEETS_BACKOFF_MAX,
+)
 
 # ----------------------------
 # Conversation states (venta y contacto)
@@ -133,6 +650,7 @@ async def get_bot_username(context: ContextTypes.DEFAULT_TYPE):
 # ----------------------------
 # Menú principal (solo en privado)
 # ----------------------------
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     user = update.effective_user
@@ -156,224 +674,2639 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.message:
             await update.message.reply_text(msg)
         else:
-            await context.bot.send_message(chat.id, msg)
+            await context.bot.send_message(chat.id, msg)
+
+# ----------------------------
+# Callback handler para el menú (gestiona privado/grupo)
+# ----------------------------
+@timed
+async def callback_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.answer()
+    data = q.data
+    chat = q.message.chat
+    user = q.from_user
+    bot_username = await get_bot_username(context)
+
+    # Si teclado en grupo => pedimos DM
+    if chat.type in ("group", "supergroup", "channel"):
+        warn = (
+            "Esta función solo funciona en privado. Pulsa aquí 👉 "
+            f"@{bot_username} y escribe /start"
+        )
+        try:
+            await q.edit_message_text("Esta opción solo funciona en privado. Comprueba tu chat con el bot.")
+        except Exception:
+            pass
+        try:
+            await context.bot.send_message(user.id, warn)
+        except Exception:
+            try:
+                await context.bot.send_message(chat.id, f"{user.first_name}, revisa tu chat privado con @{bot_username}.")
+            except Exception:
+                pass
+        return
+
+    # Si estamos en privado, procesar cada opción
+    if data == "menu_search":
+        # mostrar opciones de orden
+        kb = [
+            [InlineKeyboardButton("Top por rentabilidad", callback_data="search_sort_yield")],
+            [InlineKeyboardButton("Top por precio (más barato)", callback_data="search_sort_price")],
+            [InlineKeyboardButton("Buscar por ciudad", callback_data="search_by_city")],
+            [InlineKeyboardButton("Búsqueda con filtros", callback_data="search_filters")],
+            [InlineKeyboardButton("🔔 Mis alertas", callback_data="al:list")],
+            [InlineKeyboardButton("Volver", callback_data="menu_back")],
+        ]
+        await q.edit_message_text("Elige cómo quieres ver las propiedades:", reply_markup=InlineKeyboardMarkup(kb))
+        return
+
+    if data == "menu_sell":
+        await q.edit_message_text("Perfecto. Empezamos. ¿En qué ciudad está el piso? (ej: Madrid)")
+        return C_CITY
+
+    if data == "menu_manuals":
+        # Mostrar lista de manuales (por ahora uno)
+        txt = "Manuales / Herramientas disponibles:\n\n"
+        txt += f"- Calculadora de rentabilidad (PDF): {SAMPLE_PDF_URL}\n\n"
+        txt += "Si quieres más dosieres, los añadiremos y te avisamos."
+        await q.edit_message_text(txt)
+        return
+
+    if data == "menu_contact":
+        await q.edit_message_text("Escribe el mensaje que quieres enviar al equipo (respuesta directa al admin).")
+        return CONTACT_MSG
+
+    if data == "menu_back":
+        await q.edit_message_text("Menú principal. /start para volver.")
+        return
+
+    # search sub-options
+    if data == "search_sort_yield":
+        await q.edit_message_text("Buscando por rentabilidad...")
+        await send_listings_sorted(context, q.from_user.id, sort_by="yield")
+        return
+
+    if data == "search_sort_price":
+        await q.edit_message_text("Buscando por precio (más barato)...")
+        await send_listings_sorted(context, q.from_user.id, sort_by="price")
+        return
+
+    if data == "search_by_city":
+        await q.edit_message_text("Escribe el nombre de la ciudad que quieres buscar (ej: Madrid).")
+        # Next message will be handled by city_search_message
+        context.user_data["awaiting_city_search"] = True
+        return
+
+    if data == "search_filters":
+        txt, markup = render_filter_builder(context.user_data.setdefault("search_draft", {}))
+        await q.edit_message_text(txt, reply_markup=markup)
+        return
+
+    return
+
+# ----------------------------
+# Enviar listados: leer sheet, calcular yield y ordenar
+# ----------------------------
+def safe_float(v):
+    if isinstance(v, (int, float)):
+        return float(v)
+    if v is None or v == "":
+        return None
+    try:
+        return float(v)  # lo normal: "150000" tal cual, sin pasar por str/replace/strip
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(str(v).replace(",", "").strip())
+    except Exception:
+        return None
+
+def compute_yield(price, rent_est):
+    # yield_net_approx = (rent_est * 12) / price * 100  (percent)
+    if price and rent_est:
+        return round((rent_est * 12) / price * 100, 2)
+    return None
+
+# Posición de cada campo de Listing en SHEET_HEADER (photo <- photo_filename)
+DEFAULT_COLUMNS = tuple(range(len(SHEET_HEADER)))
+
+def header_columns(header: List[Any]):
+    # (columns para Listing.from_row, nº de columnas a leer) según el header real de la hoja
+    pos = {str(h).strip(): i for i, h in enumerate(header)}
+    return tuple(pos.get(name) for name in SHEET_HEADER), max(len(header), len(SHEET_HEADER))
+
+class Listing:
+    # Un anuncio parseado. Con __slots__ ocupa una fracción de un dict de 13 claves y el yield
+    # se calcula una sola vez al construirlo.
+    __slots__ = (
+        "timestamp",
+        "chat_id",
+        "user",
+        "city",
+        "price",
+        "m2",
+        "rent_est",
+        "state",
+        "url",
+        "notes",
+        "photo",
+        "contact",
+        "yield_pct",
+    )
+
+    def __init__(self, timestamp="", chat_id="", user="", city="", price=None, m2=None, rent_est=None,
+                 state="", url="", notes="", photo="", contact=""):
+        self.timestamp = timestamp
+        self.chat_id = chat_id
+        self.user = user
+        self.city = city
+        self.price = price
+        self.m2 = m2
+        self.rent_est = rent_est
+        self.state = state
+        self.url = url
+        self.notes = notes
+        self.photo = photo
+        self.contact = contact
+        self.yield_pct = compute_yield(price, rent_est)
+
+    @classmethod
+    def from_row(cls, row: List[Any], columns=DEFAULT_COLUMNS) -> "Listing":
+        # columns: índice en row de cada columna de SHEET_HEADER (None si la hoja no la tiene)
+        if columns is DEFAULT_COLUMNS and len(row) >= len(columns) and None not in row:
+            v = row  # fila completa en el orden de SHEET_HEADER: se lee sin copiarla
+        else:
+            n = len(row)
+            v = [row[i] if i is not None and i < n and row[i] is not None else "" for i in columns]
+        return cls(
+            v[0], v[1], v[2], v[3], safe_float(v[4]), safe_float(v[5]), safe_float(v[6]),
+            v[7], v[8], v[9], v[10], v[11],
+        )
+
+    def as_row(self) -> List[Any]:
+        # Mismo orden que SHEET_HEADER
+        return [
+            self.timestamp, self.chat_id, self.user, self.city, self.price, self.m2, self.rent_est,
+            self.state, self.url, self.notes, self.photo, self.contact,
+        ]
+
+def parse_sheet_values(values: List[List[Any]]) -> List[Listing]:
+    # values tal cual los devuelve get_all_values(): header + filas, con todas las columnas
+    columns, _ = header_columns(values[0] if values else SHEET_HEADER)
+    if columns == DEFAULT_COLUMNS:
+        columns = DEFAULT_COLUMNS  # activa el camino sin copia de from_row
+    return [Listing.from_row(r, columns) for r in values[1:]]
+
+# Columnas que lee la caché: chat_id y notes no se muestran en ninguna búsqueda ni tarjeta
+CACHE_FIELDS = tuple(name for name in SHEET_HEADER if name not in ("chat_id", "notes"))
+HEADER_RANGE = "1:1"
+
+class SheetProjection:
+    # Lectura de solo algunas columnas: los rangos contiguos de la hoja que las contienen (uno por
+    # tramo, pedidos juntos con batch_get) y cómo recomponer cada fila a partir de ellos.
+    __slots__ = ("header", "spans", "columns", "widths", "_fields")
+
+    def __init__(self, header: List[Any], fields=CACHE_FIELDS):
+        self.header = [str(h).strip() for h in header]
+        sheet_cols, _ = header_columns(self.header)
+        wanted = sorted({c for name, c in zip(SHEET_HEADER, sheet_cols) if name in fields and c is not None})
+        self.spans: List[List[int]] = []  # [primera, última] columna (0-based) de cada tramo
+        for c in wanted:
+            if self.spans and self.spans[-1][1] == c - 1:
+                self.spans[-1][1] = c
+            else:
+                self.spans.append([c, c])
+        joined = {c: i for i, c in enumerate(wanted)}
+        # columns para Listing.from_row sobre la fila recompuesta; None en lo que no se lee
+        self.columns = tuple(joined.get(c) if name in fields else None for name, c in zip(SHEET_HEADER, sheet_cols))
+        self.widths = [b - a + 1 for a, b in self.spans]
+        # Los campos que no se leen apuntan a un "" que parse() añade al final de cada fila
+        width = len(wanted)
+        self._fields = operator.itemgetter(*(width if c is None else c for c in self.columns))
+
+    def matches(self, header: List[Any]) -> bool:
+        return [str(h).strip() for h in header] == self.header
+
+    def ranges(self, first_row: int, last_row: Any = "") -> List[str]:
+        return [f"{column_letter(a + 1)}{first_row}:{column_letter(b + 1)}{last_row}" for a, b in self.spans]
+
+    def parse(self, parts: List[List[List[Any]]]) -> List[Listing]:
+        # parts: lo que devuelve batch_get para self.ranges(). La API omite las celdas vacías al
+        # final de cada fila y las filas vacías al final de cada rango: se rellenan con "". Con
+        # UNFORMATTED_VALUE los números ya llegan como int/float y safe_float solo los convierte.
+        widths, width, fields, num = self.widths, sum(self.widths), self._fields, safe_float
+        flat = itertools.chain.from_iterable
+        rows = []
+        for cells in itertools.zip_longest(*parts, fillvalue=()):
+            row = list(flat(cells))
+            if len(row) != width:
+                row = []
+                for part, w in zip(cells, widths):
+                    row += part
+                    row += [""] * (w - len(part))
+            row.append("")
+            v = fields(row)
+            rows.append(Listing(v[0], v[1], v[2], v[3], num(v[4]), num(v[5]), num(v[6]), v[7], v[8], v[9], v[10], v[11]))
+        return rows
+
+def parse_listing_row(row: List[Any]) -> Listing:
+    # Our header expected:
+    # timestamp, chat_id, user, city, price, m2, rent_est, state, url, notes, photo_filename, contact
+    return Listing.from_row(row)
+
+def fmt_num(v):
+    if v is None:
+        return ""
+    return str(int(v)) if float(v).is_integer() else str(v)
+
+# ----------------------------
+# Índices sobre el snapshot: ciudad y estado normalizados, yield, precio y m²
+# ----------------------------
+@functools.lru_cache(maxsize=8192)
+def normalize_city(name) -> str:
+    # "  Málaga " -> "malaga": sin acentos, sin mayúsculas y con espacios colapsados. Con caché:
+    # hay pocos nombres distintos y se normalizan en cada recarga del índice.
+    txt = unicodedata.normalize("NFKD", str(name or ""))
+    txt = "".join(ch for ch in txt if not unicodedata.combining(ch))
+    return " ".join(txt.casefold().split())
+
+# ----------------------------
+# Búsqueda por filtros: precio<150000 yield>7 m2>60 estado=reformado ciudad=valencia
+# ----------------------------
+class ListingQuery:
+    # Filtros combinados (todos deben cumplirse). Rangos numéricos sobre precio, yield y m², y
+    # igualdad sobre estado y ciudad normalizados. key() es la forma canónica: se guarda en
+    # user_data para paginar y parse(key()) devuelve la misma búsqueda.
+    FIELDS = {
+        "precio": "price", "price": "price",
+        "yield": "yield_pct", "rentabilidad": "yield_pct",
+        "m2": "m2", "m²": "m2", "metros": "m2",
+        "estado": "state", "state": "state",
+        "ciudad": "city", "city": "city",
+    }
+    NAMES = {"price": "precio", "yield_pct": "yield", "m2": "m2", "state": "estado", "city": "ciudad"}
+    RANGE_FIELDS = ("price", "yield_pct", "m2")
+    TERM = re.compile(r'([^\W\d_]+2?|m²)\s*(<=|>=|<|>|=|:)\s*("[^"]*"|[^\s<>=:]+)')
+
+    __slots__ = ("ranges", "state", "city")
+
+    def __init__(self):
+        self.ranges: Dict[str, List[Any]] = {}  # campo -> [lo, lo_estricto, hi, hi_estricto]
+        self.state = ""
+        self.city = ""
+
+    @classmethod
+    def parse(cls, text: str) -> "ListingQuery":
+        # ValueError con un mensaje para el usuario si algo no se entiende
+        q = cls()
+        text = text.strip()
+        pos = 0
+        for m in cls.TERM.finditer(text):
+            if text[pos:m.start()].strip():
+                raise ValueError(f"No entiendo «{text[pos:m.start()].strip()}»")
+            pos = m.end()
+            name, op, raw = m.group(1).lower(), m.group(2), m.group(3).strip('"')
+            field = cls.FIELDS.get(name)
+            if field is None:
+                raise ValueError(f"Campo desconocido: {name}")
+            if field in cls.RANGE_FIELDS:
+                value = cls._number(raw)
+                if value is None:
+                    raise ValueError(f"{name}: «{raw}» no es un número")
+                q.add_range(field, op, value)
+            elif op not in ("=", ":"):
+                raise ValueError(f"{name} solo admite =")
+            else:
+                setattr(q, field, normalize_city(raw.replace("_", " ")))
+        if text[pos:].strip():
+            raise ValueError(f"No entiendo «{text[pos:].strip()}»")
+        return q
+
+    # "." o "," seguidos de exactamente 3 cifras son separadores de miles (150.000, 1.500.000,
+    # 150,000); si no, decimales (7,5 o 7.5)
+    THOUSANDS = re.compile(r"(?<=\d)[.,](?=\d{3}(?:[.,]|$))")
+
+    @classmethod
+    def _number(cls, raw: str):
+        raw = raw.lower().rstrip("€%").strip()
+        mult = 1000 if raw.endswith("k") else 1
+        raw = raw.rstrip("k")
+        if not re.match(r"0[.,]", raw):  # 0,125 es decimal, no miles
+            raw = cls.THOUSANDS.sub("", raw)
+        value = safe_float(raw.replace(",", "."))
+        return None if value is None else value * mult
+
+    def add_range(self, field: str, op: str, value: float):
+        r = self.ranges.setdefault(field, [None, False, None, False])
+        if op in (">", ">="):
+            r[0], r[1] = value, op == ">"
+        elif op in ("<", "<="):
+            r[2], r[3] = value, op == "<"
+        else:
+            r[:] = [value, False, value, False]
+
+    def __bool__(self):
+        return bool(self.ranges or self.state or self.city)
+
+    def matches(self, l: Listing) -> bool:
+        for field, (lo, lo_strict, hi, hi_strict) in self.ranges.items():
+            v = getattr(l, field)
+            if v is None:
+                return False
+            if lo is not None and (v <= lo if lo_strict else v < lo):
+                return False
+            if hi is not None and (v >= hi if hi_strict else v > hi):
+                return False
+        if self.state and normalize_city(l.state) != self.state:
+            return False
+        if self.city and normalize_city(l.city) != self.city:
+            return False
+        return True
+
+    def key(self) -> str:
+        terms = []
+        for field in self.RANGE_FIELDS:
+            if field not in self.ranges:
+                continue
+            lo, lo_strict, hi, hi_strict = self.ranges[field]
+            name = self.NAMES[field]
+            if lo is not None and lo == hi and not lo_strict and not hi_strict:
+                terms.append(f"{name}={fmt_num(lo)}")
+                continue
+            if lo is not None:
+                terms.append(f"{name}{'>' if lo_strict else '>='}{fmt_num(lo)}")
+            if hi is not None:
+                terms.append(f"{name}{'<' if hi_strict else '<='}{fmt_num(hi)}")
+        if self.state:
+            terms.append(f"estado={self.state.replace(' ', '_')}")
+        if self.city:
+            terms.append(f"ciudad={self.city.replace(' ', '_')}")
+        return " ".join(terms)
+
+    def where_sql(self):
+        # (WHERE ..., params) para SQLiteListingStore; norm() es normalize_city registrada en SQLite
+        conds, params = [], []
+        for field, (lo, lo_strict, hi, hi_strict) in self.ranges.items():
+            if lo is not None:
+                conds.append(f"{field} {'>' if lo_strict else '>='} ?")
+                params.append(lo)
+            if hi is not None:
+                conds.append(f"{field} {'<' if hi_strict else '<='} ?")
+                params.append(hi)
+        if self.state:
+            conds.append("norm(state) = ?")
+            params.append(self.state)
+        if self.city:
+            conds.append("city_norm = ?")
+            params.append(self.city)
+        return ("WHERE " + " AND ".join(conds)) if conds else "", tuple(params)
+
+INF = float("inf")
+
+def _sorted_range(order: List[Any], lo, lo_strict: bool, hi, hi_strict: bool):
+    # order: lista ordenada de (valor, pos). Devuelve (i, j) con order[i:j] dentro del rango.
+    i, j = 0, len(order)
+    if lo is not None:
+        i = bisect.bisect_left(order, (lo, INF) if lo_strict else (lo, -1))
+    if hi is not None:
+        j = bisect.bisect_left(order, (hi, -1) if hi_strict else (hi, INF))
+    return i, max(i, j)
+
+def _positions(order: List[Any], i: int, j: int):
+    for x in range(i, j):
+        yield order[x][1]
+
+class ListingIndex:
+    # Índices por posición en ListingCache.listings. Las ordenaciones se construyen una vez al
+    # recargar y se mantienen con inserción binaria, así top-K y offset son un simple slice.
+
+    def __init__(self):
+        self.by_city: Dict[str, List[int]] = {}
+        self.by_state: Dict[str, List[int]] = {}
+        self.by_yield: List[Any] = []  # (-yield, pos): mayor rentabilidad primero
+        self.by_price: List[Any] = []  # (price, pos): más barato primero
+        self.by_m2: List[Any] = []  # (m2, pos)
+
+    def rebuild(self, listings: List[Listing]):
+        self.by_city = {}
+        self.by_state = {}
+        for pos, l in enumerate(listings):
+            self.by_city.setdefault(normalize_city(l.city), []).append(pos)
+            self.by_state.setdefault(normalize_city(l.state), []).append(pos)
+        self.by_yield = sorted((-l.yield_pct, pos) for pos, l in enumerate(listings) if l.yield_pct is not None)
+        self.by_price = sorted((l.price, pos) for pos, l in enumerate(listings) if l.price is not None)
+        self.by_m2 = sorted((l.m2, pos) for pos, l in enumerate(listings) if l.m2 is not None)
+
+    def add(self, listing: Listing, pos: int):
+        self.by_city.setdefault(normalize_city(listing.city), []).append(pos)
+        self.by_state.setdefault(normalize_city(listing.state), []).append(pos)
+        if listing.yield_pct is not None:
+            bisect.insort(self.by_yield, (-listing.yield_pct, pos))
+        if listing.price is not None:
+            bisect.insort(self.by_price, (listing.price, pos))
+        if listing.m2 is not None:
+            bisect.insort(self.by_m2, (listing.m2, pos))
+
+    def _range(self, field: str, lo, lo_strict: bool, hi, hi_strict: bool):
+        # (orden, i, j): order[i:j] son los (clave, pos) con el campo dentro del rango
+        if field == "yield_pct":
+            # by_yield guarda -yield: el rango se invierte
+            neg_lo = None if hi is None else -hi
+            neg_hi = None if lo is None else -lo
+            return (self.by_yield,) + _sorted_range(self.by_yield, neg_lo, hi_strict, neg_hi, lo_strict)
+        order = self.by_price if field == "price" else self.by_m2
+        return (order,) + _sorted_range(order, lo, lo_strict, hi, hi_strict)
+
+    def candidates(self, query: ListingQuery):
+        # (m, posiciones) del filtro más selectivo. Cada rango se cuenta con dos bisect y cada
+        # igualdad con len(), y solo se recorre el más corto. None = sin filtros indexables.
+        best = None
+        for field, bounds in query.ranges.items():
+            order, i, j = self._range(field, *bounds)
+            if best is None or j - i < best[0]:
+                best = (j - i, _positions(order, i, j))
+        for table, value in ((self.by_city, query.city), (self.by_state, query.state)):
+            if value:
+                positions = table.get(value, [])
+                if best is None or len(positions) < best[0]:
+                    best = (len(positions), iter(positions))
+        return best
+
+    def search(self, listings: List[Listing], query: ListingQuery, k: int, offset: int = 0) -> List[int]:
+        # Coincidencias ordenadas por rentabilidad (las que no tienen yield, al final)
+        best = self.candidates(query)
+        if best is None:
+            # Sin filtros: todo el catálogo, como en SQLite (los que no tienen yield, al final y
+            # en orden de llegada)
+            found = self.top("yield", k, offset)
+            if len(found) < k:
+                skip = max(0, offset - len(self.by_yield))
+                rest = (pos for pos, l in enumerate(listings) if l.yield_pct is None)
+                found += itertools.islice(rest, skip, skip + k - len(found))
+            return found
+        m, candidates = best
+        need = offset + k
+        if need * len(listings) < m * m:
+            # Filtros poco selectivos: recorrer by_yield en orden y parar al llenar la página sale más
+            # barato (≈ need·n/m comprobaciones) que filtrar y ordenar los m candidatos. Si tras m
+            # comprobaciones no se ha llenado, se sigue por el camino normal.
+            order, i, j = self.by_yield, 0, len(self.by_yield)
+            if "yield_pct" in query.ranges:
+                order, i, j = self._range("yield_pct", *query.ranges["yield_pct"])
+            found = []
+            for x in range(i, min(j, i + m)):
+                pos = order[x][1]
+                if query.matches(listings[pos]):
+                    found.append(pos)
+                    if len(found) == need:
+                        return found[offset:]
+            if j - i <= m and "yield_pct" in query.ranges:
+                # Se ha recorrido todo el rango de yield: no hay más coincidencias
+                return found[offset:offset + k]
+        found = [pos for pos in candidates if query.matches(listings[pos])]
+
+        def rank(pos):
+            y = listings[pos].yield_pct
+            return (INF if y is None else -y), pos
+        found.sort(key=rank)
+        return found[offset:offset + k]
+
+    def top(self, sort_by: str, k: int, offset: int = 0) -> List[int]:
+        order = self.by_yield if sort_by == "yield" else self.by_price
+        return [pos for _, pos in order[offset:offset + k]]
+
+    def city(self, city: str, k: int, offset: int = 0) -> List[int]:
+        return self.by_city.get(normalize_city(city), [])[offset:offset + k]
+
+# ----------------------------
+# Caché de anuncios: snapshot compartido ya parseado, con TTL y refresco incremental
+# ----------------------------
+def notify_listeners(listeners: List[Any], event: str, arg):
+    # Suscriptores del catálogo (ver ListingStore.subscribe): un fallo en uno no afecta al resto
+    # ni a la caché
+    for listener in listeners:
+        try:
+            getattr(listener, event)(arg)
+        except Exception:
+            logger.exception("Error en suscriptor %s.%s", type(listener).__name__, event)
+
+def _build_snapshot(listeners: List[Any], listings: List[Listing], index: Optional[ListingIndex]):
+    if index is not None:
+        index.rebuild(listings)
+    states = []
+    for listener in listeners:
+        try:
+            states.append((listener, listener.build(listings)))
+        except Exception:
+            logger.exception("Error en suscriptor %s.build", type(listener).__name__)
+    return states
+
+async def build_snapshot(listeners: List[Any], listings: List[Listing], index: Optional[ListingIndex] = None):
+    # Tras una carga completa, el índice y el estado de cada suscriptor se construyen en un hilo
+    # sobre objetos nuevos (con 100k anuncios son segundos de CPU) y el loop solo los intercambia
+    # con swap_snapshot: los chats siguen atendidos con el snapshot anterior mientras tanto.
+    return await asyncio.get_running_loop().run_in_executor(None, _build_snapshot, listeners, listings, index)
+
+def swap_snapshot(states):
+    for listener, state in states:
+        try:
+            listener.swap(state)
+        except Exception:
+            logger.exception("Error en suscriptor %s.swap", type(listener).__name__)
+
+class ListingCache:
+    # Mientras no pase el TTL se sirve el snapshot en memoria. Al caducar solo se piden las
+    # filas añadidas después de la última conocida; la hoja completa se vuelve a leer cuando
+    # se invalida la caché o cada LISTINGS_FULL_RELOAD segundos (para recoger ediciones a mano).
+    # Los envíos aún no volcados a la hoja (ver SubmissionQueue) se guardan aparte en _pending y
+    # se sirven igual que el resto; row_count solo cuenta filas que ya están en la hoja.
+    # Si la hoja falla (o el circuito está abierto) y ya hubo una carga buena, se sigue sirviendo
+    # ese snapshot y stale_since marca desde cuándo: las respuestas lo indican como "datos en caché".
+
+    def __init__(self, storage: SheetStorage, ttl: float, full_reload_every: float):
+        self.storage = storage
+        self.ttl = ttl
+        self.full_reload_every = full_reload_every
+        self.listings: List[Listing] = []
+        self.index = ListingIndex()
+        self.row_count = 0  # filas de datos (sin header) ya cargadas
+        self._pending: List[Listing] = []
+        self._projection = SheetProjection(SHEET_HEADER)  # se rehace si el header de la hoja cambia
+        self._refreshed_at = 0.0
+        self._full_at = 0.0
+        self._valid = False
+        self._loaded = False  # hubo al menos una carga completa buena
+        self._good_at: Optional[datetime] = None
+        self.stale_since: Optional[datetime] = None  # última lectura buena, mientras se sirve la caché
+        self._lock = None
+        self.listeners: List[Any] = []
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def invalidate(self):
+        self._valid = False
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _fresh(self) -> bool:
+        return self._valid and time.monotonic() - self._refreshed_at < self.ttl
+
+    async def get(self) -> List[Listing]:
+        if self._fresh():
+            M_CACHE.inc("hit")
+            return self.listings
+        lock = self._get_lock()
+        if self._valid and lock.locked():
+            # Ya hay un refresco en marcha: no esperar a la hoja por unas filas de hace un TTL
+            M_CACHE.inc("stale")
+            return self.listings
+        async with lock:
+            if not self._fresh():
+                try:
+                    if not self._valid or time.monotonic() - self._full_at >= self.full_reload_every:
+                        M_CACHE.inc("full")
+                        await self._full_reload()
+                    else:
+                        M_CACHE.inc("tail")
+                        await self._refresh_tail()
+                except Exception as e:
+                    if not self._loaded:
+                        raise
+                    self._serve_stale(e)
+                    return self.listings
+                self._good_at = datetime.utcnow()
+                if self.stale_since is not None:
+                    logger.info("Caché de anuncios al día de nuevo (servida en caché desde %s)", f"{self.stale_since:%H:%M:%S}")
+                    self.stale_since = None
+            else:
+                M_CACHE.inc("hit")
+        return self.listings
+
+    def _serve_stale(self, exc: BaseException):
+        M_CACHE.inc("stale")
+        if self.stale_since is None:
+            self.stale_since = self._good_at
+            logger.warning("No se pudo refrescar la caché (%s: %s); se sirve la última copia", type(exc).__name__, exc)
+
+    async def _read(self, first_row: int, last_row: Any = "") -> List[Listing]:
+        # Header y columnas de CACHE_FIELDS en una sola petición. Si el header no es el esperado
+        # (columnas movidas a mano), se rehace la proyección y se vuelve a pedir.
+        proj = self._projection
+        parts = await self.storage.batch_get([HEADER_RANGE] + proj.ranges(first_row, last_row))
+        header = parts[0][0] if parts[0] else SHEET_HEADER
+        if not proj.matches(header):
+            self._projection = proj = SheetProjection(header)
+            parts = [None] + await self.storage.batch_get(proj.ranges(first_row, last_row))
+        return await asyncio.get_running_loop().run_in_executor(None, proj.parse, parts[1:])
+
+    async def _full_reload(self):
+        rows = await self._read(2)
+        pending = list(self._pending)
+        listings = rows + pending
+        index = ListingIndex()
+        states = await build_snapshot(self.listeners, listings, index)
+        # Intercambio atómico (sin awaits); los envíos confirmados durante la construcción se
+        # añadieron al snapshot viejo y se añaden ahora al nuevo
+        self.listings = listings
+        self.index = index
+        swap_snapshot(states)
+        for listing in self._pending[len(pending):]:
+            self._add(listing)
+        self.row_count = len(rows)
+        self._full_at = self._refreshed_at = time.monotonic()
+        self._valid = self._loaded = True
+        logger.info("Caché de anuncios recargada: %d filas", self.row_count)
+
+    async def _refresh_tail(self):
+        proj = self._projection
+        rows = proj.parse(await self.storage.batch_get(proj.ranges(self.row_count + 2)))
+        for r in rows:
+            self._add(r)
+        self.row_count += len(rows)
+        self._refreshed_at = time.monotonic()
+
+    def _add(self, listing: Listing):
+        self.index.add(listing, len(self.listings))
+        self.listings.append(listing)
+        notify_listeners(self.listeners, "add", listing)
+
+    async def top(self, sort_by: str, k: int, offset: int = 0) -> List[Listing]:
+        listings = await self.get()
+        if sort_by in ("yield", "price"):
+            return [listings[pos] for pos in self.index.top(sort_by, k, offset)]
+        ordered = sorted(listings, key=lambda x: str(getattr(x, sort_by) or "").lower())
+        return ordered[offset:offset + k]
+
+    async def by_city(self, city: str, k: int, offset: int = 0) -> List[Listing]:
+        listings = await self.get()
+        return [listings[pos] for pos in self.index.city(city, k, offset)]
+
+    async def search(self, query: ListingQuery, k: int, offset: int = 0) -> List[Listing]:
+        listings = await self.get()
+        return [listings[pos] for pos in self.index.search(listings, query, k, offset)]
+
+    async def latest(self, n: int) -> List[Listing]:
+        # Con snapshot cargado sale de memoria (get() solo lee las filas nuevas). En frío no se
+        # carga la hoja entera: se cuentan las filas y se leen el header y las n últimas.
+        if self._valid:
+            return (await self.get())[-n:]
+        total = await self.storage.count_rows()
+        first = max(2, total - n + 1)
+        rows = await self._read(first, total) if total >= first else []
+        return (rows + self._pending)[-n:]
+
+    def add_pending(self, listing: Listing):
+        # Visible en las lecturas en cuanto se confirma, aunque aún no esté en la hoja (también
+        # si se está sirviendo la caché porque la hoja no responde)
+        self._pending.append(listing)
+        if self._loaded:
+            self._add(listing)
+
+    async def discard_pending(self, n: int):
+        # Los n primeros pendientes no se van a subir (SubmissionQueue los ha apartado): fuera de
+        # _pending y también del snapshot, del índice y de los suscriptores, que se rehacen sin
+        # ellos como en _full_reload. Con el lock, como write_rows, para no cruzarse con una recarga.
+        async with self._get_lock():
+            gone = {id(l) for l in self._pending[:n]}
+            del self._pending[:n]
+            if not gone or not self._loaded:
+                return
+            kept = len(self._pending)
+            listings = [l for l in self.listings if id(l) not in gone]
+            index = ListingIndex()
+            states = await build_snapshot(self.listeners, listings, index)
+            self.listings = listings
+            self.index = index
+            swap_snapshot(states)
+            for listing in self._pending[kept:]:
+                self._add(listing)
+
+    async def write_rows(self, rows: List[List[Any]]):
+        # Vuelca a la hoja los primeros len(rows) pendientes. Se hace con el lock tomado para que
+        # un refresco de la cola no los lea otra vez como filas nuevas.
+        async with self._get_lock():
+            resp = await self.storage.append_rows(rows)
+            del self._pending[:len(rows)]
+            if not self._valid:
+                return
+            updated = str((resp or {}).get("updates", {}).get("updatedRange", ""))
+            m = re.search(r"![A-Z]+(\d+)", updated)
+            if m and int(m.group(1)) == self.row_count + 2:
+                self.row_count += len(rows)
+            else:
+                # Otra escritura se nos adelantó: las posiciones ya no cuadran, recarga completa
+                self.invalidate()
+
+LISTINGS = ListingCache(SHEET_STORAGE, LISTINGS_TTL, LISTINGS_FULL_RELOAD)
+
+# ----------------------------
+# Envíos: diario local (SQLite) + volcado en segundo plano a la hoja
+# ----------------------------
+class SQLiteThread:
+    # Base para los almacenes SQLite locales: todo el acceso pasa por un único hilo propio, así la
+    # conexión no se comparte entre hilos y el event loop nunca espera a un fsync.
+    schema: List[str] = []
+    functions: Dict[str, Any] = {}  # funciones SQL de un argumento: nombre -> callable
+
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for name, fn in self.functions.items():
+                conn.create_function(name, 1, fn, deterministic=True)
+            for stmt in self.schema:
+                conn.execute(stmt)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+class SubmissionJournal(SQLiteThread):
+    # Diario append-only de envíos confirmados pendientes de subir a Sheets
+    schema = [
+        "CREATE TABLE IF NOT EXISTS pending_rows ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, row TEXT NOT NULL, "
+        "created_at TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)",
+        # Filas que la hoja rechaza una y otra vez: ya no se reintentan y un admin decide qué hacer
+        "CREATE TABLE IF NOT EXISTS parked_rows ("
+        "id INTEGER PRIMARY KEY, row TEXT NOT NULL, created_at TEXT NOT NULL, "
+        "attempts INTEGER NOT NULL, error TEXT NOT NULL, parked_at TEXT NOT NULL)",
+    ]
+
+    def __init__(self, path: str):
+        super().__init__(path, "journal")
+
+    def _add(self, row):
+        db = self._db()
+        cur = db.execute(
+            "INSERT INTO pending_rows (row, created_at) VALUES (?, ?)",
+            (json.dumps(row, ensure_ascii=False, default=str), datetime.utcnow().isoformat()),
+        )
+        db.commit()
+        return cur.lastrowid
+
+    def _pending(self, limit):
+        cur = self._db().execute("SELECT id, row, attempts FROM pending_rows ORDER BY id LIMIT ?", (limit,))
+        return [(i, json.loads(r), a) for i, r, a in cur.fetchall()]
+
+    def _done(self, ids):
+        db = self._db()
+        db.executemany("DELETE FROM pending_rows WHERE id = ?", [(i,) for i in ids])
+        db.commit()
+
+    def _failed(self, ids):
+        db = self._db()
+        db.executemany("UPDATE pending_rows SET attempts = attempts + 1 WHERE id = ?", [(i,) for i in ids])
+        db.commit()
+
+    def _park(self, ids, error):
+        db = self._db()
+        now = datetime.utcnow().isoformat()
+        db.executemany(
+            "INSERT INTO parked_rows SELECT id, row, created_at, attempts, ?, ? FROM pending_rows WHERE id = ?",
+            [(error, now, i) for i in ids],
+        )
+        db.executemany("DELETE FROM pending_rows WHERE id = ?", [(i,) for i in ids])
+        db.commit()
+
+    def _count(self):
+        return self._db().execute("SELECT COUNT(*) FROM pending_rows").fetchone()[0]
+
+    async def add(self, row: List[Any]) -> int:
+        return await self._run(self._add, row)
+
+    async def pending(self, limit: int = -1):
+        return await self._run(self._pending, limit)
+
+    async def done(self, ids: List[int]):
+        await self._run(self._done, ids)
+
+    async def failed(self, ids: List[int]):
+        await self._run(self._failed, ids)
+
+    async def park(self, ids: List[int], error: str):
+        await self._run(self._park, ids, error)
+
+    async def count(self) -> int:
+        return await self._run(self._count)
+
+class SubmissionQueue:
+    # Write-behind: c_confirm solo escribe en el diario local (y en la caché) y responde al momento.
+    # Una tarea de fondo sube los pendientes con append_rows por lotes, con reintentos y backoff
+    # exponencial. Si el bot se reinicia, lo que quedó en el diario se vuelve a subir al arrancar.
+    # Entrega "al menos una vez": un corte justo entre append_rows y el borrado puede duplicar filas.
+    # Si la hoja rechaza un lote y no es por una caída (429/5xx, red, circuito abierto) ni por las
+    # credenciales, sus filas cuentan un intento y se reintentan de una en una; la que llega a max_attempts se aparta
+    # a parked_rows y se avisa a los admins, para que una fila mala no bloquee el diario entero.
+
+    def __init__(self, journal: SubmissionJournal, cache: ListingCache, batch: int, interval: float,
+                 max_backoff: float, max_attempts: int = FLUSH_MAX_ATTEMPTS):
+        self.journal = journal
+        self.cache = cache
+        self.batch = max(1, batch)
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.max_attempts = max(1, max_attempts)
+        self._wake = None
+        self._task = None
+        self._flushing = None  # volcado lanzado por _loop (puede seguir vivo tras cancelar _loop)
+        self._stopping = False
+        self._lock = None
+
+    async def submit(self, row: List[Any]):
+        await self.journal.add(row)
+        self.cache.add_pending(Listing.from_row(row))
+        if self._wake is not None:
+            self._wake.set()
+
+    async def start(self):
+        self._wake = asyncio.Event()
+        self._stopping = False
+        restored = await self.journal.pending()
+        for _, row, _ in restored:
+            self.cache.add_pending(Listing.from_row(row))
+        if restored:
+            logger.info("Diario de envíos: %d filas pendientes de subir a Sheets", len(restored))
+            self._wake.set()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self, timeout: float = 10):
+        # Cancelar _loop solo corta su espera: el volcado en curso está protegido con shield, porque
+        # cancelarlo no pararía el append_rows que corre en su hilo y las filas, aún sin marcar en
+        # el diario, se subirían otra vez en el volcado final. Se espera a que acabe y luego se vuelca.
+        # _stopping cubre el caso en que wait_for se traga la cancelación (si la espera acaba a la
+        # vez): _loop sale igualmente en cuanto vuelve de ella.
+        task, self._task = self._task, None
+        self._stopping = True
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        try:
+            if self._flushing is not None:
+                await asyncio.wait_for(asyncio.gather(self._flushing, return_exceptions=True), timeout)
+            await asyncio.wait_for(self.flush(), timeout)
+        except Exception:
+            logger.warning("No se pudieron volcar todos los envíos antes de parar; quedan en el diario")
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def flush(self) -> int:
+        # Un solo volcado a la vez: dos en paralelo leerían del diario las mismas filas
+        async with self._get_lock():
+            total = 0
+            while True:
+                items = await self.journal.pending(self.batch)
+                if not items:
+                    return total
+                if items[0][2]:
+                    items = items[:1]  # ya falló antes: sola, para no arrastrar al resto del lote
+                ids = [i for i, _, _ in items]
+                try:
+                    await self.cache.write_rows([row for _, row, _ in items])
+                except Exception as e:
+                    if isinstance(e, SheetsUnavailable) or is_transient_error(e) or is_auth_error(e):
+                        raise
+                    await self.journal.failed(ids)
+                    if items[0][2] + 1 < self.max_attempts or len(items) > 1:
+                        raise
+                    await self._park(items[0], e)
+                    continue
+                await self.journal.done(ids)
+                total += len(items)
+
+    async def _park(self, item, exc: BaseException):
+        i, row, attempts = item
+        error = (str(exc) or type(exc).__name__)[:500]
+        await self.journal.park([i], error)
+        await self.cache.discard_pending(1)
+        logger.error("Envío %d apartado tras %d intentos fallidos: %s", i, attempts + 1, error)
+        notify_admins(
+            f"⚠️ Un envío no se puede subir a Sheets tras {attempts + 1} intentos y se ha apartado "
+            f"(parked_rows, id {i}).\n{row[2]} · {row[3]} · {row[8]}\nError: {error}"
+        )
+
+    async def _loop(self):
+        delay = self.interval
+        while True:
+            if delay > self.interval:
+                await asyncio.sleep(delay)
+            else:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            if self._stopping:
+                return
+            self._wake.clear()
+            try:
+                self._flushing = asyncio.ensure_future(self.flush())
+                n = await asyncio.shield(self._flushing)
+                if n:
+                    logger.info("Subidos %d envíos a Sheets", n)
+                delay = self.interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = min(max(delay, 1.0) * 2, self.max_backoff) * random.uniform(0.8, 1.2)
+                # Con el circuito abierto no tiene sentido intentarlo antes de la próxima prueba
+                delay = max(delay, self.cache.storage.breaker.retry_in())
+                logger.warning("No se pudieron subir envíos a Sheets (%s). Reintento en %.0fs", e, delay)
+
+SUBMISSIONS = SubmissionQueue(
+    SubmissionJournal(DB_PATH), LISTINGS, FLUSH_BATCH, FLUSH_INTERVAL, FLUSH_MAX_BACKOFF
+)
+
+# ----------------------------
+# Almacén de anuncios: interfaz común + backends Google Sheets y SQLite
+# ----------------------------
+class ListingStore:
+    # Lo que los handlers necesitan de la persistencia. Los resultados son Listing.
+
+    def subscribe(self, listener):
+        # listener.build(listings) construye en un hilo el estado para el catálogo completo al
+        # cargarlo, listener.swap(estado) lo pone en uso y listener.add(listing) recibe cada
+        # anuncio que se añade después
+        raise NotImplementedError
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stale_since(self) -> Optional[datetime]:
+        # Hora (UTC) de la última lectura buena si ahora se sirve una copia porque la fuente no responde
+        return None
+
+    async def append(self, row: List[Any]):
+        # row en el orden de SHEET_HEADER
+        raise NotImplementedError
+
+    async def top(self, sort_by: str, k: int, offset: int = 0) -> List[Listing]:
+        raise NotImplementedError
+
+    async def by_city(self, city: str, k: int, offset: int = 0) -> List[Listing]:
+        raise NotImplementedError
+
+    async def search(self, query: ListingQuery, k: int, offset: int = 0) -> List[Listing]:
+        # Anuncios que cumplen todos los filtros, por rentabilidad
+        raise NotImplementedError
+
+    async def latest(self, n: int) -> List[Listing]:
+        raise NotImplementedError
+
+    async def iter_chunks(self, size: int):
+        # Todos los anuncios en orden de llegada, de size en size (generador asíncrono de listas):
+        # para recorrer el catálogo completo sin tenerlo entero en memoria
+        raise NotImplementedError
+        yield
+
+    async def cities(self) -> Dict[str, int]:
+        # ciudad normalizada -> nº de anuncios
+        raise NotImplementedError
+
+class SheetsListingStore(ListingStore):
+    # La hoja es la fuente de verdad: lecturas desde la caché indexada, escrituras vía diario
+
+    def __init__(self, cache: ListingCache, submissions: SubmissionQueue):
+        self.cache = cache
+        self.submissions = submissions
+
+    def subscribe(self, listener):
+        self.cache.subscribe(listener)
+
+    async def start(self):
+        await self.submissions.start()
+
+    async def stop(self):
+        await self.submissions.stop()
+
+    def stale_since(self) -> Optional[datetime]:
+        return self.cache.stale_since
+
+    async def append(self, row: List[Any]):
+        await self.submissions.submit(row)
+
+    async def top(self, sort_by: str, k: int, offset: int = 0) -> List[Listing]:
+        return await self.cache.top(sort_by, k, offset)
+
+    async def by_city(self, city: str, k: int, offset: int = 0) -> List[Listing]:
+        return await self.cache.by_city(city, k, offset)
+
+    async def search(self, query: ListingQuery, k: int, offset: int = 0) -> List[Listing]:
+        return await self.cache.search(query, k, offset)
+
+    async def latest(self, n: int) -> List[Listing]:
+        return await self.cache.latest(n)
+
+    async def iter_chunks(self, size: int):
+        # Directamente de la hoja, por rangos de filas (no del snapshot en memoria). Los envíos aún
+        # en el diario no se incluyen: llegan a la hoja en unos segundos.
+        storage = self.cache.storage
+        header = (await storage.batch_get([HEADER_RANGE]))[0]
+        proj = SheetProjection(header[0] if header else SHEET_HEADER, fields=SHEET_HEADER)
+        first = 2
+        while True:
+            rows = proj.parse(await storage.batch_get(proj.ranges(first, first + size - 1)))
+            if rows:
+                yield rows
+            if len(rows) < size:
+                return
+            first += size
+
+    async def cities(self) -> Dict[str, int]:
+        await self.cache.get()
+        return {c: len(pos) for c, pos in self.cache.index.by_city.items() if c}
+
+LISTING_COLUMNS_SQL = ", ".join(SHEET_HEADER)
+
+class SQLiteListingStore(SQLiteThread, ListingStore):
+    # Índice local con las mismas columnas que la hoja (+ ciudad normalizada y yield precalculado).
+    # Si hay espejo, cada envío también se encola para subirlo a Sheets en segundo plano.
+    schema = [
+        "CREATE TABLE IF NOT EXISTS listings ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "timestamp TEXT, chat_id TEXT, user TEXT, city TEXT, price REAL, m2 REAL, rent_est REAL, "
+        "state TEXT, url TEXT, notes TEXT, photo_filename TEXT, contact TEXT, "
+        "city_norm TEXT NOT NULL DEFAULT '', yield_pct REAL)",
+        "CREATE INDEX IF NOT EXISTS listings_city ON listings (city_norm, id)",
+        "CREATE INDEX IF NOT EXISTS listings_yield ON listings (yield_pct DESC, id) WHERE yield_pct IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS listings_price ON listings (price, id) WHERE price IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS listings_m2 ON listings (m2, id) WHERE m2 IS NOT NULL",
+        # seeded: cuándo se importó la hoja; sin esa clave la importación sigue pendiente
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    ]
+    functions = {"norm": normalize_city}
+
+    def __init__(self, path: str, mirror: SubmissionQueue = None):
+        super().__init__(path, "listings-db")
+        self.mirror = mirror
+        self.listeners: List[Any] = []
+        self._seeder = None
+        # append() y la recarga de los suscriptores tras la importación no se cruzan
+        self._lock = asyncio.Lock()
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def _insert(self, listings: List[Listing], commit: bool = True):
+        db = self._db()
+        db.executemany(
+            f"INSERT INTO listings ({LISTING_COLUMNS_SQL}, city_norm, yield_pct) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                [str(v) if isinstance(v, int) else v for v in l.as_row()] + [normalize_city(l.city), l.yield_pct]
+                for l in listings
+            ],
+        )
+        if commit:
+            db.commit()
+
+    def _query(self, where: str, order: str, params: tuple, k: int, offset: int) -> List[Listing]:
+        sql = f"SELECT {LISTING_COLUMNS_SQL} FROM listings {where} ORDER BY {order} LIMIT ? OFFSET ?"
+        return [Listing.from_row(r) for r in self._db().execute(sql, params + (k, offset))]
+
+    def _count(self):
+        return self._db().execute("SELECT COUNT(*) FROM listings").fetchone()[0]
+
+    def _seeded(self) -> bool:
+        return self._db().execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone() is not None
+
+    @staticmethod
+    def _key(l: Listing):
+        return l.timestamp, str(l.chat_id), l.url
+
+    def _seed(self, listings: List[Listing]) -> int:
+        # En una sola transacción: las filas de la hoja primero y detrás las locales que aún no
+        # están en ella (envíos hechos mientras la importación fallaba; el espejo ya los sube)
+        db = self._db()
+        sheet = {self._key(l) for l in listings}
+        local = [l for l in self._query("", "id", (), -1, 0) if self._key(l) not in sheet]
+        db.execute("DELETE FROM listings")
+        self._insert(listings + local, commit=False)
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('seeded', ?)", (datetime.utcnow().isoformat(),))
+        db.commit()
+        return len(local)
+
+    async def start(self):
+        if self.mirror is not None:
+            await self.mirror.start()
+            if not await self._run(self._seeded) and not await self._import_sheet():
+                self._seeder = asyncio.create_task(self._seed_loop())
+        await self._reload_listeners()
+
+    async def _reload_listeners(self):
+        if not self.listeners:
+            return
+        async with self._lock:
+            listings = await self._run(self._query, "", "id", (), -1, 0)
+            swap_snapshot(await build_snapshot(self.listeners, listings))
+
+    async def _import_sheet(self) -> bool:
+        # Primera vez con SQLite: importar lo que ya hay en la hoja
+        try:
+            values = await self.mirror.cache.storage.get_all_values()
+            rows = parse_sheet_values(values)
+            local = await self._run(self._seed, rows)
+        except Exception:
+            logger.exception("No se pudo importar la hoja a SQLite")
+            return False
+        logger.info("Importadas %d filas de Sheets a SQLite (%d envíos locales conservados)", len(rows), local)
+        return True
+
+    async def _seed_loop(self):
+        # Reintenta la importación con backoff hasta que salga; luego recarga los suscriptores
+        delay = 1.0
+        while True:
+            delay = min(delay * 2, self.mirror.max_backoff) * random.uniform(0.8, 1.2)
+            await asyncio.sleep(max(delay, self.mirror.cache.storage.breaker.retry_in()))
+            if await self._import_sheet():
+                break
+        self._seeder = None
+        await self._reload_listeners()
+
+    async def stop(self):
+        if self._seeder is not None:
+            self._seeder.cancel()
+            self._seeder = None
+        if self.mirror is not None:
+            await self.mirror.stop()
+
+    async def append(self, row: List[Any]):
+        listing = Listing.from_row(row)
+        async with self._lock:
+            await self._run(self._insert, [listing])
+            notify_listeners(self.listeners, "add", listing)
+        if self.mirror is not None:
+            await self.mirror.submit(row)
+
+    async def top(self, sort_by: str, k: int, offset: int = 0) -> List[Listing]:
+        if sort_by == "yield":
+            return await self._run(self._query, "WHERE yield_pct IS NOT NULL", "yield_pct DESC, id", (), k, offset)
+        if sort_by == "price":
+            return await self._run(self._query, "WHERE price IS NOT NULL", "price, id", (), k, offset)
+        return await self._run(self._query, "", "lower(city), id", (), k, offset)
+
+    async def by_city(self, city: str, k: int, offset: int = 0) -> List[Listing]:
+        return await self._run(self._query, "WHERE city_norm = ?", "id", (normalize_city(city),), k, offset)
+
+    async def search(self, query: ListingQuery, k: int, offset: int = 0) -> List[Listing]:
+        where, params = query.where_sql()
+        order = "yield_pct IS NULL, yield_pct DESC, id"
+        return await self._run(self._query, where, order, params, k, offset)
+
+    async def latest(self, n: int) -> List[Listing]:
+        return list(reversed(await self._run(self._query, "", "id DESC", (), n, 0)))
+
+    def _cursor(self):
+        return self._db().execute(f"SELECT {LISTING_COLUMNS_SQL} FROM listings ORDER BY id")
+
+    async def iter_chunks(self, size: int):
+        # Un cursor y fetchmany, siempre en el hilo propio de la base de datos
+        cur = await self._run(self._cursor)
+        try:
+            while True:
+                rows = await self._run(cur.fetchmany, size)
+                if not rows:
+                    return
+                yield [Listing.from_row(r) for r in rows]
+        finally:
+            await self._run(cur.close)
+
+    def _cities(self):
+        sql = "SELECT city_norm, COUNT(*) FROM listings WHERE city_norm != '' GROUP BY city_norm"
+        return dict(self._db().execute(sql).fetchall())
+
+    async def cities(self) -> Dict[str, int]:
+        return await self._run(self._cities)
+
+def make_store() -> ListingStore:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteListingStore(DB_PATH, SUBMISSIONS if SHEETS_MIRROR else None)
+    return SheetsListingStore(LISTINGS, SUBMISSIONS)
+
+STORE = make_store()
+
+# ----------------------------
+# Estadísticas de mercado: vista columnar del catálogo + agregados por ciudad incrementales
+# ----------------------------
+YIELD_BINS = (4, 6, 8, 10)  # tramos de yield (%): <4, 4-6, 6-8, 8-10, >=10
+_MONTH_RE = re.compile(r"^(\d{4})-(\d{2})")
+
+class MarketAggregate:
+    # Agregados de un grupo (una ciudad o el total). Las listas ordenadas dan la mediana en O(1) y
+    # se mantienen con insort al añadir; el histograma de yield y el volumen mensual son contadores.
+    __slots__ = ("n", "prices", "ppm2", "yields", "yield_hist", "months")
+
+    def __init__(self):
+        self.n = 0
+        self.prices: List[float] = []
+        self.ppm2: List[float] = []
+        self.yields: List[float] = []
+        self.yield_hist = [0] * (len(YIELD_BINS) + 1)
+        self.months: Dict[str, int] = collections.Counter()
+
+    def add(self, price, ppm2, yield_pct, month, insert=bisect.insort):
+        # insert=list.append para cargas en bloque: luego hay que llamar a sort()
+        self.n += 1
+        if price is not None:
+            insert(self.prices, price)
+        if ppm2 is not None:
+            insert(self.ppm2, ppm2)
+        if yield_pct is not None:
+            insert(self.yields, yield_pct)
+            self.yield_hist[bisect.bisect_right(YIELD_BINS, yield_pct)] += 1
+        if month:
+            self.months[month] += 1
+
+    def sort(self):
+        self.prices.sort()
+        self.ppm2.sort()
+        self.yields.sort()
+
+    @classmethod
+    def from_columns(cls, np, n, price, ppm2, yields, months, month_names) -> "MarketAggregate":
+        # Lo mismo que n llamadas a add(), sobre columnas numpy de un grupo (NaN = sin dato)
+        agg = cls()
+        agg.n = n
+        agg.prices = np.sort(price[~np.isnan(price)]).tolist()
+        agg.ppm2 = np.sort(ppm2[~np.isnan(ppm2)]).tolist()
+        y = np.sort(yields[~np.isnan(yields)])
+        agg.yields = y.tolist()
+        agg.yield_hist = np.bincount(np.searchsorted(YIELD_BINS, y, side="right"), minlength=len(YIELD_BINS) + 1).tolist()
+        ids, counts = np.unique(months[months >= 0], return_counts=True)
+        agg.months = collections.Counter({month_names[i]: int(c) for i, c in zip(ids.tolist(), counts.tolist())})
+        return agg
+
+def median(sorted_values: List[float]):
+    n = len(sorted_values)
+    if not n:
+        return None
+    mid = n // 2
+    return sorted_values[mid] if n % 2 else (sorted_values[mid - 1] + sorted_values[mid]) / 2
+
+class MarketStats:
+    # Suscriptor del catálogo (STORE.subscribe). Guarda price, m2, yield, ciudad y mes en columnas
+    # array (NaN / -1 = sin dato) y agregados por ciudad. add() los actualiza al momento
+    # (c_confirm, refresco de la caché); tras una carga completa build() los recalcula de golpe en
+    # un hilo, vectorizado con numpy (en requirements.txt; sin él, en Python puro), y swap() los
+    # pone en uso.
+
+    def __init__(self):
+        self._reset_columns()
+
+    def _reset_columns(self):
+        self.price = array.array("d")
+        self.m2 = array.array("d")
+        self.yield_pct = array.array("d")
+        self.city = array.array("q")  # id en city_names
+        self.month = array.array("q")  # id en month_names, -1 sin fecha
+        self.city_names: List[str] = []
+        self.month_names: List[str] = []
+        self._city_ids: Dict[str, int] = {}
+        self._month_ids: Dict[str, int] = {}
+        self.total = MarketAggregate()
+        self.by_city: Dict[str, MarketAggregate] = {}
+        self.display: Dict[str, str] = {}  # ciudad normalizada -> nombre tal como se escribió
+
+    def _append(self, l: Listing):
+        # Añade a las columnas; devuelve (ciudad, ppm2, mes) para los agregados
+        nan = float("nan")
+        city = normalize_city(l.city)
+        cid = self._city_ids.get(city)
+        if cid is None:
+            cid = self._city_ids[city] = len(self.city_names)
+            self.city_names.append(city)
+            self.display[city] = " ".join(str(l.city).split())
+        m = _MONTH_RE.match(str(l.timestamp or ""))
+        month = f"{m.group(1)}-{m.group(2)}" if m else ""
+        mid = -1
+        if month:
+            mid = self._month_ids.get(month)
+            if mid is None:
+                mid = self._month_ids[month] = len(self.month_names)
+                self.month_names.append(month)
+        ppm2 = l.price / l.m2 if l.price and l.m2 else None
+        self.price.append(nan if l.price is None else l.price)
+        self.m2.append(nan if l.m2 is None else l.m2)
+        self.yield_pct.append(nan if l.yield_pct is None else l.yield_pct)
+        self.city.append(cid)
+        self.month.append(mid)
+        return city, ppm2, month
+
+    def add(self, l: Listing, insert=bisect.insort):
+        city, ppm2, month = self._append(l)
+        for agg in (self.total, self.by_city.setdefault(city, MarketAggregate())):
+            agg.add(l.price, ppm2, l.yield_pct, month, insert)
+
+    def build(self, listings: List[Listing]) -> "MarketStats":
+        # En un hilo (ver build_snapshot): estadísticas nuevas sin tocar las que se están sirviendo
+        fresh = MarketStats()
+        fresh.reset(listings)
+        return fresh
+
+    def swap(self, fresh: "MarketStats"):
+        self.__dict__.update(fresh.__dict__)
+
+    def reset(self, listings: List[Listing]):
+        t0 = time.perf_counter()
+        self._reset_columns()
+        if importlib.util.find_spec("numpy") is None:
+            for l in listings:
+                self.add(l, list.append)
+            for agg in (self.total, *self.by_city.values()):
+                agg.sort()
+        else:
+            for l in listings:
+                self._append(l)
+            self._aggregate_numpy()
+        logger.info("Estadísticas de mercado recalculadas: %d anuncios en %.0f ms", len(listings), (time.perf_counter() - t0) * 1000)
+
+    def _aggregate_numpy(self):
+        import numpy as np
+        price = np.frombuffer(self.price, dtype=np.float64)
+        m2 = np.frombuffer(self.m2, dtype=np.float64)
+        yields = np.frombuffer(self.yield_pct, dtype=np.float64)
+        city = np.frombuffer(self.city, dtype=np.int64)
+        month = np.frombuffer(self.month, dtype=np.int64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ppm2 = price / m2
+        ppm2[(price == 0) | (m2 == 0)] = np.nan  # mismo criterio que add(): precio y m² no nulos
+        self.total = MarketAggregate.from_columns(np, len(city), price, ppm2, yields, month, self.month_names)
+        # Agrupar por ciudad ordenando una vez (estable: mantiene el orden de llegada)
+        order = np.argsort(city, kind="stable")
+        bounds = np.flatnonzero(np.diff(city[order])) + 1
+        for group in np.split(order, bounds):
+            if len(group):
+                name = self.city_names[int(city[group[0]])]
+                self.by_city[name] = MarketAggregate.from_columns(
+                    np, len(group), price[group], ppm2[group], yields[group], month[group], self.month_names
+                )
+
+MARKET = MarketStats()
+STORE.subscribe(MARKET)
+
+# ----------------------------
+# Duplicados: mismo enlace normalizado o mismo piso (ciudad, precio y m² casi iguales)
+# ----------------------------
+_TRACKING_PARAM = re.compile(r"^(utm_.*|fbclid|gclid|ref|xtor|from)$", re.I)
+# Con esquema vale cualquier host; sin él ("idealista.com/inmueble/123", tal cual lo pega el
+# vendedor) solo uno con pinta de dominio, seguido de ruta, puerto, query o fin del texto
+_URL_RE = re.compile(
+    r"^(?:https?://(?:www\.|m\.)?([^/?#:@\s]+)|(?:www\.|m\.)?((?:[a-z0-9-]+\.)+[a-z]{2,})(?=[/?#:]|$))"
+    r"(?::\d+)?([^?#\s]*)(?:\?([^#\s]*))?",
+    re.I,
+)
+
+def normalize_url(url) -> str:
+    # "https://www.idealista.com/inmueble/123/?utm_source=x" -> "idealista.com/inmueble/123".
+    # "" si no parece un enlace (el vendedor puede escribir "no"). Con regex en vez de urlsplit:
+    # se llama para cada anuncio al reconstruir el índice.
+    m = _URL_RE.match(str(url or "").strip())
+    if m is None:
+        return ""
+    host, bare_host, path, query = m.groups()
+    norm = (host or bare_host).lower() + path.rstrip("/")
+    if query:
+        params = sorted((k, v) for k, v in parse_qsl(query) if not _TRACKING_PARAM.match(k))
+        if params:
+            norm += "?" + urlencode(params)
+    return norm
+
+class DuplicateIndex:
+    # Suscriptor del catálogo. by_url: hash de 8 bytes del enlace normalizado -> último anuncio con
+    # ese enlace. by_near: (ciudad, tramo de precio, tramo de m²) -> anuncios; un posible duplicado
+    # se busca en los 9 tramos vecinos, así que la consulta no depende del tamaño del catálogo.
+    PRICE_STEP = 5000
+    M2_STEP = 5
+    MAX_BUCKET = 50  # anuncios guardados por tramo; basta para avisar
+
+    def __init__(self):
+        self.by_url: Dict[bytes, Listing] = {}
+        self.by_near: Dict[Any, List[Listing]] = {}
+
+    @staticmethod
+    def url_key(url):
+        norm = normalize_url(url)
+        return hashlib.blake2b(norm.encode(), digest_size=8).digest() if norm else None
+
+    def near_key(self, l: Listing, dp: int = 0, dm: int = 0):
+        if l.price is None or l.m2 is None or not l.city:
+            return None
+        return normalize_city(l.city), int(l.price // self.PRICE_STEP) + dp, int(l.m2 // self.M2_STEP) + dm
+
+    def build(self, listings: List[Listing]) -> "DuplicateIndex":
+        fresh = DuplicateIndex()
+        fresh.reset(listings)
+        return fresh
+
+    def swap(self, fresh: "DuplicateIndex"):
+        self.by_url, self.by_near = fresh.by_url, fresh.by_near
+
+    def reset(self, listings: List[Listing]):
+        t0 = time.perf_counter()
+        self.by_url = {}
+        self.by_near = {}
+        for l in listings:
+            self.add(l)
+        logger.info("Índice de duplicados: %d enlaces en %.0f ms", len(self.by_url), (time.perf_counter() - t0) * 1000)
+
+    def add(self, l: Listing):
+        key = self.url_key(l.url)
+        if key is not None:
+            self.by_url[key] = l
+        key = self.near_key(l)
+        if key is not None:
+            bucket = self.by_near.setdefault(key, [])
+            if len(bucket) < self.MAX_BUCKET:
+                bucket.append(l)
+
+    def same_url(self, l: Listing):
+        key = self.url_key(l.url)
+        return None if key is None else self.by_url.get(key)
+
+    def similar(self, l: Listing, limit: int = 3) -> List[Listing]:
+        # Misma ciudad, precio a menos de PRICE_STEP y m² a menos de M2_STEP
+        found = []
+        for dp in (-1, 0, 1):
+            for dm in (-1, 0, 1):
+                for other in self.by_near.get(self.near_key(l, dp, dm), ()):
+                    if abs(other.price - l.price) <= self.PRICE_STEP and abs(other.m2 - l.m2) <= self.M2_STEP:
+                        found.append(other)
+                        if len(found) == limit:
+                            return found
+        return found
+
+DUPLICATES = DuplicateIndex()
+STORE.subscribe(DUPLICATES)
+
+# ----------------------------
+# Envíos salientes: cola central con límites de Telegram (global y por chat)
+# ----------------------------
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        # Segundos hasta que haya un token (0 si ya lo hay); no consume
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        # Consume un token y devuelve cuánto hay que esperar para usarlo
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+class _ChatSlot:
+    __slots__ = ("pending", "bucket", "scheduled")
+
+    def __init__(self, bucket: TokenBucket):
+        self.pending = collections.deque()
+        self.bucket = bucket
+        self.scheduled = False  # en la cola de listos, en un timer o en manos de un worker
+
+class OutboundDispatcher:
+    # Todos los envíos pasan por aquí. Cada chat tiene su propia cola y su token bucket, y hay un
+    # bucket global. Un chat está como mucho una vez en la cola de listos, así sus mensajes salen
+    # en orden y de uno en uno, mientras los workers atienden otros chats en paralelo. Si un chat
+    # tiene que esperar (límite por chat, RetryAfter o error de red) se reprograma con un timer en
+    # vez de bloquear un worker; un RetryAfter además pausa los envíos globales ese tiempo.
+
+    def __init__(self, workers: int, global_rate: float, chat_rate: float, group_rate: float,
+                 chat_burst: int, max_retries: int):
+        self.workers = max(1, workers)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.bot = None
+        self.sent = 0
+        self.retries = 0
+        self.depth = 0  # mensajes aceptados y aún sin resolver
+        self._ready = None
+        self._idle = None
+        self._tasks: List[Any] = []
+        self._slots: Dict[Any, _ChatSlot] = {}
+        self._paused_until = 0.0
+
+    def start(self, bot):
+        self.bot = bot
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        if self._idle is not None:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Cola de envíos con %d mensajes sin enviar al parar", self.depth)
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+
+    def submit(self, chat_id, *args, method: str = "send_message", **kwargs) -> asyncio.Future:
+        # Encola y devuelve un Future con el resultado; no hace falta esperarlo
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_consume_future_exception)
+        slot = self._slot(chat_id)
+        slot.pending.append([method, args, kwargs, fut, 0])
+        self.depth += 1
+        self._idle.clear()
+        if not slot.scheduled:
+            slot.scheduled = True
+            self._ready.put_nowait(chat_id)
+        return fut
+
+    async def send(self, chat_id, *args, method: str = "send_message", **kwargs):
+        return await self.submit(chat_id, *args, method=method, **kwargs)
+
+    def _slot(self, chat_id) -> _ChatSlot:
+        slot = self._slots.get(chat_id)
+        if slot is None:
+            if len(self._slots) >= 1024:
+                self._slots = {k: v for k, v in self._slots.items() if v.scheduled or not v.bucket.idle()}
+            is_group = (isinstance(chat_id, int) and chat_id < 0) or str(chat_id).startswith("@")
+            rate = self.group_rate if is_group else self.chat_rate
+            slot = self._slots[chat_id] = _ChatSlot(TokenBucket(rate, self.chat_burst))
+        return slot
+
+    def _later(self, delay: float, chat_id):
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    def _resolve(self, slot: _ChatSlot, chat_id, result=None, exc: BaseException = None):
+        _, _, _, fut, _ = slot.pending.popleft()
+        if not fut.done():
+            fut.set_exception(exc) if exc is not None else fut.set_result(result)
+        self.depth -= 1
+        if self.depth == 0:
+            self._idle.set()
+        if slot.pending:
+            self._ready.put_nowait(chat_id)
+        else:
+            slot.scheduled = False
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            slot = self._slots[chat_id]
+            try:
+                await self._deliver(slot, chat_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error inesperado en la cola de envíos")
+
+    async def _deliver(self, slot: _ChatSlot, chat_id):
+        job = slot.pending[0]
+        method, args, kwargs, fut, attempts = job
+        if fut.cancelled():
+            return self._resolve(slot, chat_id)
+        wait = max(self._paused_until - time.monotonic(), slot.bucket.wait_time())
+        if wait > 0:
+            return self._later(wait, chat_id)
+        slot.bucket.reserve()
+        wait = self.global_bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        t0 = time.perf_counter()
+        try:
+            result = await getattr(self.bot, method)(chat_id, *args, **kwargs)
+        except RetryAfter as e:
+            M_TG_RETRIES.inc("retry_after")
+            self.retries += 1
+            job[4] += 1
+            if attempts >= self.max_retries:
+                return self._resolve(slot, chat_id, exc=e)
+            self._paused_until = max(self._paused_until, time.monotonic() + float(e.retry_after))
+            logger.warning("Flood control de Telegram: pausa de %ss (chat %s)", e.retry_after, chat_id)
+            return self._later(float(e.retry_after), chat_id)
+        except TimedOut as e:
+            # Puede que el mensaje sí llegara: no se reintenta para no duplicarlo
+            M_TG_ERRORS.inc("TimedOut")
+            return self._resolve(slot, chat_id, exc=e)
+        except (BadRequest, Forbidden, ChatMigrated) as e:
+            # Errores permanentes (chat inexistente, bot bloqueado, texto o teclado inválidos).
+            # BadRequest hereda de NetworkError: va antes para no reintentarlo ni bloquear el chat.
+            M_TG_ERRORS.inc(type(e).__name__)
+            return self._resolve(slot, chat_id, exc=e)
+        except NetworkError as e:
+            M_TG_RETRIES.inc("network")
+            self.retries += 1
+            job[4] += 1
+            if attempts >= self.max_retries:
+                return self._resolve(slot, chat_id, exc=e)
+            return self._later(min(2 ** attempts, 30), chat_id)
+        except Exception as e:
+            M_TG_ERRORS.inc(type(e).__name__)
+            return self._resolve(slot, chat_id, exc=e)
+        finally:
+            M_TG_SECONDS.observe(time.perf_counter() - t0, method)
+        self.sent += 1
+        self._resolve(slot, chat_id, result)
+
+def _consume_future_exception(fut: asyncio.Future):
+    # Los envíos "dispara y olvida" no deben dejar excepciones sin recoger; se registran aquí
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.warning("Envío a Telegram fallido: %s", fut.exception())
+
+OUTBOX = OutboundDispatcher(
+    SEND_WORKERS, SEND_RATE_GLOBAL, SEND_RATE_CHAT, SEND_RATE_GROUP, SEND_BURST_CHAT, SEND_MAX_RETRIES
+)
+
+# ----------------------------
+# Fotos: file_id al momento, descarga en segundo plano deduplicada por contenido
+# ----------------------------
+PHOTO_VARIANTS = {"thumb": 320, "1280": 1280}  # nombre -> lado mayor en px
+
+def is_file_id(photo: str) -> bool:
+    # Los envíos antiguos guardaban la ruta local (./uploads/photo_<uid>_<ts>.jpg)
+    return bool(photo) and not photo.startswith(("./", "/")) and not photo.endswith(".jpg")
+
+def make_photo_variants(path: str) -> List[str]:
+    # Se ejecuta en el pool de procesos: miniatura y versión comprimida junto al original
+    from PIL import Image
+
+    base, _ = os.path.splitext(path)
+    out = []
+    with Image.open(path) as img:
+        img = img.convert("RGB")
+        for name, size in PHOTO_VARIANTS.items():
+            variant = img.copy()
+            variant.thumbnail((size, size))
+            vpath = f"{base}_{name}.jpg"
+            variant.save(vpath, "JPEG", quality=70, optimize=True)
+            out.append(vpath)
+    return out
+
+class PhotoDB(SQLiteThread):
+    schema = [
+        "CREATE TABLE IF NOT EXISTS photos ("
+        "file_unique_id TEXT PRIMARY KEY, file_id TEXT NOT NULL, sha256 TEXT NOT NULL, "
+        "path TEXT NOT NULL, created_at TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS photos_sha ON photos (sha256)",
+        # Fotos aceptadas y aún sin descargar: sobreviven a un reinicio y se reanudan al arrancar
+        "CREATE TABLE IF NOT EXISTS photo_jobs ("
+        "file_unique_id TEXT PRIMARY KEY, file_id TEXT NOT NULL, created_at TEXT NOT NULL, "
+        "attempts INTEGER NOT NULL DEFAULT 0)",
+    ]
+
+    def __init__(self, path: str):
+        super().__init__(path, "photos-db")
+
+    def _known(self, file_unique_id: str) -> bool:
+        cur = self._db().execute("SELECT 1 FROM photos WHERE file_unique_id = ?", (file_unique_id,))
+        return cur.fetchone() is not None
+
+    def _add(self, file_unique_id: str, file_id: str, sha: str, path: str):
+        # La foto queda registrada y su trabajo pendiente se borra en la misma transacción
+        db = self._db()
+        db.execute(
+            "INSERT OR IGNORE INTO photos (file_unique_id, file_id, sha256, path, created_at) VALUES (?, ?, ?, ?, ?)",
+            (file_unique_id, file_id, sha, path, datetime.utcnow().isoformat()),
+        )
+        db.execute("DELETE FROM photo_jobs WHERE file_unique_id = ?", (file_unique_id,))
+        db.commit()
+
+    def _add_job(self, file_id: str, file_unique_id: str):
+        db = self._db()
+        db.execute(
+            "INSERT OR IGNORE INTO photo_jobs (file_unique_id, file_id, created_at) VALUES (?, ?, ?)",
+            (file_unique_id, file_id, datetime.utcnow().isoformat()),
+        )
+        db.commit()
+
+    def _jobs(self, max_attempts: int):
+        cur = self._db().execute(
+            "SELECT file_id, file_unique_id FROM photo_jobs WHERE attempts < ? ORDER BY created_at", (max_attempts,)
+        )
+        return cur.fetchall()
+
+    def _job_done(self, file_unique_id: str):
+        db = self._db()
+        db.execute("DELETE FROM photo_jobs WHERE file_unique_id = ?", (file_unique_id,))
+        db.commit()
+
+    def _job_failed(self, file_unique_id: str):
+        db = self._db()
+        db.execute("UPDATE photo_jobs SET attempts = attempts + 1 WHERE file_unique_id = ?", (file_unique_id,))
+        db.commit()
+
+    async def known(self, file_unique_id: str) -> bool:
+        return await self._run(self._known, file_unique_id)
+
+    async def add(self, file_unique_id: str, file_id: str, sha: str, path: str):
+        await self._run(self._add, file_unique_id, file_id, sha, path)
+
+    async def add_job(self, file_id: str, file_unique_id: str):
+        await self._run(self._add_job, file_id, file_unique_id)
+
+    async def jobs(self, max_attempts: int):
+        return await self._run(self._jobs, max_attempts)
+
+    async def job_done(self, file_unique_id: str):
+        await self._run(self._job_done, file_unique_id)
+
+    async def job_failed(self, file_unique_id: str):
+        await self._run(self._job_failed, file_unique_id)
+
+class PhotoPipeline:
+    # c_photo solo guarda file_id/file_unique_id y encola; aquí se descarga después. La misma foto
+    # reenviada (mismo file_unique_id) no se vuelve a descargar, y el fichero se nombra por su
+    # sha256, así dos fotos idénticas ocupan un solo fichero. Las variantes (miniatura y
+    # comprimida) se generan en un pool de procesos si Pillow está instalado.
+    # Cada foto encolada se apunta antes en photo_jobs (como las filas en SubmissionJournal): si el
+    # bot se reinicia con descargas pendientes, start() las reanuda. Una que falla MAX_ATTEMPTS
+    # veces se queda en la tabla y ya no se reintenta.
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, db: PhotoDB, directory: str, workers: int, variant_procs: int):
+        self.db = db
+        self.directory = directory
+        self.workers = max(1, workers)
+        self.variant_procs = variant_procs
+        self.bot = None
+        self._queue = None
+        self._tasks: List[Any] = []
+        self._procs = None
+
+    async def start(self, bot):
+        self.bot = bot
+        self._queue = asyncio.Queue()
+        if self.variant_procs > 0 and importlib.util.find_spec("PIL") is not None:
+            self._procs = ProcessPoolExecutor(max_workers=self.variant_procs)
+        restored = await self.db.jobs(self.MAX_ATTEMPTS)
+        for job in restored:
+            self._queue.put_nowait(tuple(job))
+        if restored:
+            logger.info("Fotos pendientes de descargar: %d", len(restored))
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Quedan %d fotos sin descargar al parar", self._queue.qsize())
+        for t in self._tasks:
+            t.cancel()
+        self._tasks = []
+        if self._procs is not None:
+            self._procs.shutdown(wait=False)
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def enqueue(self, file_id: str, file_unique_id: str):
+        await self.db.add_job(file_id, file_unique_id)
+        if self._queue is not None:
+            self._queue.put_nowait((file_id, file_unique_id))
+
+    async def _worker(self):
+        while True:
+            file_id, file_unique_id = await self._queue.get()
+            try:
+                await self._process(file_id, file_unique_id)
+            except Exception:
+                logger.exception("Error procesando la foto %s", file_unique_id)
+                try:
+                    await self.db.job_failed(file_unique_id)
+                except Exception:
+                    logger.exception("No se pudo apuntar el fallo de la foto %s", file_unique_id)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, file_id: str, file_unique_id: str):
+        if await self.db.known(file_unique_id):
+            await self.db.job_done(file_unique_id)
+            return
+        tg_file = await self.bot.get_file(file_id)
+        data = bytes(await tg_file.download_as_bytearray())
+        sha = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.directory, sha[:2], f"{sha}.jpg")
+        loop = asyncio.get_running_loop()
+        if not os.path.exists(path):
+            await loop.run_in_executor(None, _write_file, path, data)
+            if self._procs is not None:
+                try:
+                    await loop.run_in_executor(self._procs, make_photo_variants, path)
+                except Exception:
+                    logger.exception("Error generando variantes de %s", path)
+        await self.db.add(file_unique_id, file_id, sha, path)
+
+def _write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+PHOTOS = PhotoPipeline(PhotoDB(DB_PATH), PHOTO_DIR, PHOTO_WORKERS, PHOTO_VARIANT_PROCS)
+
+# ----------------------------
+# Servidor HTTP de operaciones (salud) para el balanceador
+# ----------------------------
+class OpsServer:
+    # HTTP mínimo sobre asyncio para endpoints internos (GET). Cada ruta devuelve
+    # (status, content_type, body). Va en su propio puerto, aparte del webhook de Telegram.
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes: Dict[str, Any] = {}
+        self._server = None
+
+    def route(self, path: str, fn):
+        self.routes[path] = fn
+
+    async def start(self):
+        if self.port:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info("Servidor de operaciones en %s:%s (%s)", self.host, self.port, ", ".join(self.routes))
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            method, target = request.split(b"\r\n", 1)[0].decode("latin-1").split(" ")[:2]
+            fn = self.routes.get(target.split("?", 1)[0])
+            if method != "GET":
+                status, ctype, body = 405, "text/plain", "method not allowed"
+            elif fn is None:
+                status, ctype, body = 404, "text/plain", "not found"
+            else:
+                status, ctype, body = fn()
+        except Exception:
+            status, ctype, body = 400, "text/plain", "bad request"
+        data = body.encode()
+        reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+        writer.write(
+            f"HTTP/1.1 {status} {reason.get(status, '')}\r\nContent-Type: {ctype}\r\n"
+            f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+OPS = OpsServer(HEALTH_LISTEN, HEALTH_PORT)
+STARTED_AT = time.monotonic()
+
+def admin_notify_target():
+    # ADMIN_NOTIFY puede ser @username o id numérico
+    return int(ADMIN_NOTIFY) if str(ADMIN_NOTIFY).isdigit() else ADMIN_NOTIFY
+
+def notify_admins(text: str) -> List[asyncio.Future]:
+    return [OUTBOX.submit(a, text) for a in ADMIN_IDS]
+
+# ----------------------------
+# Resultados paginados: un solo mensaje con botones anterior/siguiente
+# ----------------------------
+PAGE_SIZE = 5
+
+# modo -> título; el cursor va en callback_data: pg:<modo>:<offset>[:<arg>]. En las búsquedas
+# ("q") el arg no cabe en 64 bytes: la consulta va en user_data["search_query"] y solo viaja el offset.
+PAGE_TITLES = {
+    "y": "📈 Top por rentabilidad",
+    "p": "💶 Top por precio (más barato)",
+    "c": "🏙 Pisos en {city}",
+    "q": "🔎 {query}",
+}
+
+def page_callback_data(mode: str, offset: int, arg: str = "", prefix: str = "pg") -> str:
+    data = f"{prefix}:{mode}:{offset}"
+    if arg:
+        # callback_data admite 64 bytes como máximo
+        room = 64 - len(data.encode()) - 1
+        data += ":" + arg.encode()[:room].decode(errors="ignore")
+    return data
+
+async def fetch_page(mode: str, arg: str, offset: int, k: int) -> List[Listing]:
+    if mode == "y":
+        return await STORE.top("yield", k, offset)
+    if mode == "p":
+        return await STORE.top("price", k, offset)
+    if mode == "c":
+        return await STORE.by_city(arg, k, offset)
+    if mode == "q":
+        return await STORE.search(ListingQuery.parse(arg), k, offset)
+    raise ValueError(f"modo de página desconocido: {mode}")
+
+def render_listing(n: int, l: Listing) -> str:
+    txt = f"{n}. 🏠 {l.city or '—'} · Precio: {fmt_num(l.price) or '—'}€ · m²: {fmt_num(l.m2) or '—'}\n"
+    if l.yield_pct is not None:
+        txt += f"📈 Yield aprox.: {l.yield_pct} %\n"
+    if l.url:
+        txt += f"🔗 {l.url}\n"
+    if l.contact:
+        txt += f"📞 {l.contact}\n"
+    if l.timestamp:
+        txt += f"Publicado: {l.timestamp}\n"
+    return txt
+
+def cached_note() -> str:
+    # Aviso en las respuestas servidas desde la última copia buena mientras la hoja no responde
+    since = STORE.stale_since()
+    return "" if since is None else f"⚠️ datos en caché (de las {since:%H:%M} UTC)\n"
+
+async def render_page(mode: str, arg: str = "", offset: int = 0):
+    # Devuelve (texto, teclado) o (None, None) si no hay resultados en esa página
+    rows = await fetch_page(mode, arg, offset, PAGE_SIZE + 1)  # uno de más para saber si hay siguiente
+    has_next = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if not rows:
+        return None, None
+    title = PAGE_TITLES[mode].format(city=rows[0].city or arg, query=arg)
+    txt = f"{title} · {offset + 1}–{offset + len(rows)}\n{cached_note()}\n"
+    txt += "\n".join(render_listing(offset + i + 1, l) for i, l in enumerate(rows))
+    cb_arg = "" if mode == "q" else arg
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("« Anterior", callback_data=page_callback_data(mode, max(0, offset - PAGE_SIZE), cb_arg)))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Siguiente »", callback_data=page_callback_data(mode, offset + PAGE_SIZE, cb_arg)))
+    keyboard = [buttons] if buttons else []
+    if any(is_file_id(l.photo) for l in rows):
+        keyboard.append([InlineKeyboardButton("📷 Ver fotos", callback_data=page_callback_data(mode, offset, cb_arg, prefix="ph"))])
+    return txt, InlineKeyboardMarkup(keyboard) if keyboard else None
+
+async def send_page(chat_id, mode: str, arg: str = "") -> bool:
+    txt, markup = await render_page(mode, arg)
+    if txt is None:
+        return False
+    await OUTBOX.send(chat_id, txt, reply_markup=markup, disable_web_page_preview=True)
+    return True
+
+def page_arg(mode: str, rest: List[str], context: ContextTypes.DEFAULT_TYPE) -> str:
+    if mode == "q":
+        query = context.user_data.get("search_query")
+        if query is None:
+            raise LookupError("búsqueda caducada")
+        return query
+    return rest[0] if rest else ""
+
+@timed
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Botones anterior/siguiente: se edita el mismo mensaje, servido desde la caché indexada
+    q = update.callback_query
+    try:
+        _, mode, offset, *rest = q.data.split(":", 3)
+        txt, markup = await render_page(mode, page_arg(mode, rest, context), max(0, int(offset)))
+    except LookupError:
+        await q.answer("La búsqueda ha caducado. Vuelve a lanzar /buscar.", show_alert=True)
+        return
+    except Exception:
+        logger.exception("Error paginando resultados")
+        await q.answer("No puedo leer las oportunidades ahora.", show_alert=True)
+        return
+    await q.answer()
+    if txt is None:
+        await q.edit_message_reply_markup(reply_markup=None)
+        return
+    await q.edit_message_text(txt, reply_markup=markup, disable_web_page_preview=True)
+
+@timed
+async def photos_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Fotos de la página como álbum, reenviadas por file_id: sin descargar ni volver a subir nada
+    q = update.callback_query
+    try:
+        _, mode, offset, *rest = q.data.split(":", 3)
+        offset = max(0, int(offset))
+        rows = await fetch_page(mode, page_arg(mode, rest, context), offset, PAGE_SIZE)
+    except LookupError:
+        await q.answer("La búsqueda ha caducado. Vuelve a lanzar /buscar.", show_alert=True)
+        return
+    except Exception:
+        logger.exception("Error leyendo fotos de la página")
+        await q.answer("No puedo leer las oportunidades ahora.", show_alert=True)
+        return
+    media = [
+        InputMediaPhoto(l.photo, caption=f"{offset + i + 1}. {l.city} · {fmt_num(l.price)}€")
+        for i, l in enumerate(rows)
+        if is_file_id(l.photo)
+    ]
+    await q.answer()
+    if media:
+        OUTBOX.submit(q.message.chat.id, method="send_media_group", media=media)
+
+async def send_listings_sorted(context: ContextTypes.DEFAULT_TYPE, chat_id, sort_by="yield"):
+    try:
+        found = await send_page(chat_id, "y" if sort_by == "yield" else "p")
+    except Exception as e:
+        logger.exception("Error leyendo sheet para listados")
+        await context.bot.send_message(chat_id, "No puedo leer las oportunidades ahora. Revisa configuración.")
+        return
+
+    if not found:
+        await context.bot.send_message(chat_id, "No hay listados disponibles con esos criterios.")
+
+# ----------------------------
+# Comandos /<ciudad>: búsqueda por prefijo y con erratas sobre un trie de ciudades
+# ----------------------------
+def osa_distance(a: str, b: str) -> int:
+    # Levenshtein + intercambio de dos letras contiguas como una sola edición ("madird" -> madrid
+    # a distancia 1), la errata más común al teclear
+    prev2, prev = None, list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        row = [i]
+        for j, cb in enumerate(b, 1):
+            d = min(row[j - 1] + 1, prev[j] + 1, prev[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb and ca != cb:
+                d = min(d, prev2[j - 2] + 1)
+            row.append(d)
+        prev2, prev = prev, row
+    return prev[-1]
+
+def _deletes(word: str, depth: int) -> set:
+    # word y todas sus variantes quitando hasta depth letras
+    out = frontier = {word}
+    for _ in range(depth):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        out = out | frontier
+    return out
+
+class CityMatcher:
+    # Ciudades normalizadas en dos estructuras: un trie para prefijos ("mad" -> madrid) y un
+    # índice de borrados tipo SymSpell para erratas: cada ciudad se registra bajo sus variantes
+    # con hasta MAX_DIST letras menos, y una consulta solo compara contra las ciudades que
+    # comparten alguna variante (también las tiene en común un intercambio de letras contiguas,
+    # que osa_distance cuenta como una sola edición). Así la búsqueda con erratas no recorre todas
+    # las ciudades.
+    # Solo se corrige una letra y nunca la primera: "valencia" a distancia 1 de "palencia" es otra
+    # ciudad, no una errata, y con más distancia los nombres cortos se confunden entre sí.
+    # Es suscriptor del catálogo (STORE.subscribe): se construye con la carga completa y add()
+    # cuenta cada anuncio nuevo, así resolver una ciudad no consulta el almacén.
+    MAX_DIST = 1
+    _END = None  # clave de fin de palabra en los nodos del trie
+
+    def __init__(self, counts: Dict[str, int]):
+        self.counts: Dict[str, int] = {}
+        self.root: Dict[Any, Any] = {}
+        self.deletes: Dict[str, List[str]] = {}
+        for name, n in counts.items():
+            self._insert(name)
+            self.counts[name] = n
+
+    def _insert(self, name: str):
+        node = self.root
+        for ch in name:
+            node = node.setdefault(ch, {})
+        node[self._END] = name
+        for variant in _deletes(name, self.MAX_DIST):
+            self.deletes.setdefault(variant, []).append(name)
+
+    def build(self, listings: List[Listing]) -> "CityMatcher":
+        # En un hilo (ver build_snapshot)
+        counts = collections.Counter(normalize_city(l.city) for l in listings)
+        counts.pop("", None)
+        return CityMatcher(counts)
+
+    def swap(self, fresh: "CityMatcher"):
+        self.__dict__.update(fresh.__dict__)
+
+    def add(self, listing: Listing):
+        name = normalize_city(listing.city)
+        if not name:
+            return
+        if name not in self.counts:
+            self._insert(name)
+            self.counts[name] = 0
+        self.counts[name] += 1
+
+    def _names_under(self, node) -> List[str]:
+        out, stack = [], [node]
+        while stack:
+            n = stack.pop()
+            for ch, child in n.items():
+                if ch is self._END:
+                    out.append(child)
+                else:
+                    stack.append(child)
+        return out
+
+    def prefix(self, q: str) -> List[str]:
+        node = self.root
+        for ch in q:
+            node = node.get(ch)
+            if node is None:
+                return []
+        return self._names_under(node)
+
+    def fuzzy(self, q: str, max_dist: int) -> List[Any]:
+        # [(distancia, nombre)] de las ciudades a distancia <= max_dist
+        candidates = set()
+        for variant in _deletes(q, min(max_dist, self.MAX_DIST)):
+            candidates.update(self.deletes.get(variant, ()))
+        found = []
+        for name in candidates:
+            if name[:1] == q[:1] and abs(len(name) - len(q)) <= max_dist:
+                d = osa_distance(q, name)
+                if d <= max_dist:
+                    found.append((d, name))
+        return found
+
+    def resolve(self, query: str, fuzzy: bool = True):
+        # fuzzy=False: solo nombre exacto o prefijo (p. ej. alertas, que se guardan para ciudades
+        # que quizá aún no tienen anuncios y no deben acabar en otra parecida)
+        q = normalize_city(query)
+        if not q:
+            return None
+        if q in self.counts:
+            return q
+        if len(q) >= 3:
+            names = self.prefix(q)
+            if names:
+                return max(names, key=lambda n: (self.counts[n], n))
+        close = self.fuzzy(q, self.MAX_DIST) if fuzzy and len(q) >= 4 else None
+        if close:
+            return min(close, key=lambda d: (d[0], -self.counts[d[1]], d[1]))[1]
+        return None
+
+CITIES = CityMatcher({})
+STORE.subscribe(CITIES)
+
+async def resolve_city(query: str, fuzzy: bool = True):
+    # Normaliza y corrige el nombre contra las ciudades que tienen anuncios. Si aún no hay ninguna
+    # (la hoja no se pudo cargar al arrancar), STORE.cities() fuerza la carga, que llena CITIES.
+    if not CITIES.counts:
+        await STORE.cities()
+    return CITIES.resolve(query, fuzzy)
+
+class ReplyCoalescer:
+    # Una ráfaga del mismo comando en un grupo comparte un único cálculo: las peticiones
+    # simultáneas esperan al mismo Future y el resultado se reutiliza durante ttl segundos.
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._done: Dict[Any, Any] = {}  # key -> (expira, resultado)
+        self._running: Dict[Any, asyncio.Future] = {}
+
+    async def get(self, key, compute):
+        hit = self._done.get(key)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+        fut = self._running.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = self._running[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await compute()
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()  # que no quede como excepción sin recoger si nadie más esperaba
+            raise
+        else:
+            fut.set_result(result)
+            if len(self._done) > 512:
+                now = time.monotonic()
+                self._done = {k: v for k, v in self._done.items() if v[0] > now}
+            self._done[key] = (time.monotonic() + self.ttl, result)
+            return result
+        finally:
+            del self._running[key]
+
+CITY_REPLIES = ReplyCoalescer(CITY_REPLY_TTL)
+
+async def city_reply(query: str):
+    # (texto, teclado) para /<ciudad>, compartido entre peticiones iguales
+    async def compute():
+        city = await resolve_city(query)
+        if city is None:
+            return f"No he encontrado listados para {query.replace('_', ' ').capitalize()}.", None
+        return await render_page("c", city)
+    return await CITY_REPLIES.get(normalize_city(query), compute)
+
+# ----------------------------
+# /buscar: filtros combinados, escritos o con el teclado de filtros
+# ----------------------------
+SEARCH_HELP = (
+    "Uso: /buscar precio<150000 yield>7 m2>60 estado=reformado ciudad=valencia\n"
+    "Campos: precio, yield, m2 (con <, <=, >, >= o =), estado y ciudad (con =). "
+    "Para nombres con espacios usa _ o comillas. Sin filtros se abre el teclado."
+)
+
+# campo -> (etiqueta, [(texto del botón, término)]). Un término por campo: pulsar otro lo sustituye.
+FILTER_PRESETS = {
+    "precio": ("💶", [("<100k", "precio<100000"), ("<150k", "precio<150000"), ("<250k", "precio<250000")]),
+    "yield": ("📈", [(">5%", "yield>5"), (">7%", "yield>7"), (">9%", "yield>9")]),
+    "m2": ("📐", [(">50 m²", "m2>50"), (">70 m²", "m2>70"), (">90 m²", "m2>90")]),
+    "estado": ("🛠", [("Reformado", "estado=reformado"), ("A reformar", "estado=a_reformar")]),
+}
+
+def render_filter_builder(draft: Dict[str, str]):
+    current = " ".join(draft.values()) or "(sin filtros)"
+    txt = f"Elige los filtros y pulsa Buscar.\nFiltros: {current}"
+    kb = []
+    for field, (icon, options) in FILTER_PRESETS.items():
+        kb.append([
+            InlineKeyboardButton(f"{'✅' if draft.get(field) == term else icon} {label}", callback_data=f"flt:{field}:{i}")
+            for i, (label, term) in enumerate(options)
+        ])
+    city = draft.get("ciudad", "").partition("=")[2].replace("_", " ")
+    kb.append([InlineKeyboardButton(f"🏙 {city.title() if city else 'Ciudad…'}", callback_data="flt:city")])
+    kb.append([
+        InlineKeyboardButton("🔎 Buscar", callback_data="flt:go"),
+        InlineKeyboardButton("Limpiar", callback_data="flt:clear"),
+    ])
+    kb.append([InlineKeyboardButton("🔔 Crear alerta", callback_data="al:new")])
+    return txt, InlineKeyboardMarkup(kb)
+
+async def run_search(context: ContextTypes.DEFAULT_TYPE, chat_id, query: ListingQuery) -> bool:
+    # Envía la primera página y deja la consulta en user_data para los botones de paginación
+    if query.city:
+        resolved = await resolve_city(query.city)
+        if resolved is None:
+            return False
+        query.city = resolved
+    key = query.key()
+    context.user_data["search_query"] = key
+    return await send_page(chat_id, "q", key)
+
+async def search_and_reply(context: ContextTypes.DEFAULT_TYPE, chat_id, query: ListingQuery):
+    try:
+        found = await run_search(context, chat_id, query)
+    except Exception:
+        logger.exception("Error buscando con filtros")
+        await context.bot.send_message(chat_id, "No puedo leer las oportunidades ahora. Revisa configuración.")
+        return
+    if not found:
+        await context.bot.send_message(chat_id, "No hay pisos que cumplan esos filtros.")
+
+@timed
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = " ".join(context.args or [])
+    try:
+        query = ListingQuery.parse(text)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}.\n\n{SEARCH_HELP}")
+        return
+    if not query:
+        txt, markup = render_filter_builder(context.user_data.setdefault("search_draft", {}))
+        await update.message.reply_text(txt, reply_markup=markup)
+        return
+    await search_and_reply(context, update.effective_chat.id, query)
+
+@timed
+async def filter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Teclado de filtros: flt:<campo>:<opción> alterna un filtro, flt:city pide la ciudad por texto
+    q = update.callback_query
+    draft = context.user_data.setdefault("search_draft", {})
+    _, action, *rest = q.data.split(":", 2)
+    if action == "go":
+        await q.answer()
+        await search_and_reply(context, q.message.chat.id, ListingQuery.parse(" ".join(draft.values())))
+        return
+    if action == "city":
+        await q.answer()
+        context.user_data["awaiting_filter_city"] = True
+        await context.bot.send_message(q.message.chat.id, "Escribe la ciudad (ej: Valencia).")
+        return
+    if action == "clear":
+        draft.clear()
+    elif action in FILTER_PRESETS and rest and rest[0].isdigit() and int(rest[0]) < len(FILTER_PRESETS[action][1]):
+        term = FILTER_PRESETS[action][1][int(rest[0])][1]
+        if draft.get(action) == term:
+            del draft[action]
+        else:
+            draft[action] = term
+    await q.answer()
+    txt, markup = render_filter_builder(draft)
+    await q.edit_message_text(txt, reply_markup=markup)
 
 # ----------------------------
-# Callback handler para el menú (gestiona privado/grupo)
+# Alertas: búsquedas guardadas que se avisan al confirmar un piso nuevo
 # ----------------------------
-async def callback_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    await q.answer()
-    data = q.data
-    chat = q.message.chat
-    user = q.from_user
-    bot_username = await get_bot_username(context)
+class AlertDB(SQLiteThread):
+    schema = [
+        "CREATE TABLE IF NOT EXISTS alerts ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, query TEXT NOT NULL, created_at TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS alerts_chat ON alerts (chat_id)",
+    ]
 
-    # Si teclado en grupo => pedimos DM
-    if chat.type in ("group", "supergroup", "channel"):
-        warn = (
-            "Esta función solo funciona en privado. Pulsa aquí 👉 "
-            f"@{bot_username} y escribe /start"
+    def __init__(self, path: str):
+        super().__init__(path, "alerts-db")
+
+    def _add(self, chat_id: int, query: str) -> int:
+        db = self._db()
+        cur = db.execute(
+            "INSERT INTO alerts (chat_id, query, created_at) VALUES (?, ?, ?)",
+            (chat_id, query, datetime.utcnow().isoformat()),
         )
-        try:
-            await q.edit_message_text("Esta opción solo funciona en privado. Comprueba tu chat con el bot.")
-        except Exception:
-            pass
-        try:
-            await context.bot.send_message(user.id, warn)
-        except Exception:
-            try:
-                await context.bot.send_message(chat.id, f"{user.first_name}, revisa tu chat privado con @{bot_username}.")
-            except Exception:
-                pass
-        return
+        db.commit()
+        return cur.lastrowid
 
-    # Si estamos en privado, procesar cada opción
-    if data == "menu_search":
-        # mostrar opciones de orden
-        kb = [
-            [InlineKeyboardButton("Top por rentabilidad", callback_data="search_sort_yield")],
-            [InlineKeyboardButton("Top por precio (más barato)", callback_data="search_sort_price")],
-            [InlineKeyboardButton("Buscar por ciudad", callback_data="search_by_city")],
-            [InlineKeyboardButton("Volver", callback_data="menu_back")],
-        ]
-        await q.edit_message_text("Elige cómo quieres ver las propiedades:", reply_markup=InlineKeyboardMarkup(kb))
-        return
+    def _delete(self, alert_id: int, chat_id: int) -> bool:
+        db = self._db()
+        cur = db.execute("DELETE FROM alerts WHERE id = ? AND chat_id = ?", (alert_id, chat_id))
+        db.commit()
+        return cur.rowcount > 0
 
-    if data == "menu_sell":
-        await q.edit_message_text("Perfecto. Empezamos. ¿En qué ciudad está el piso? (ej: Madrid)")
-        return C_CITY
+    def _all(self):
+        return self._db().execute("SELECT id, chat_id, query FROM alerts ORDER BY id").fetchall()
 
-    if data == "menu_manuals":
-        # Mostrar lista de manuales (por ahora uno)
-        txt = "Manuales / Herramientas disponibles:\n\n"
-        txt += f"- Calculadora de rentabilidad (PDF): {SAMPLE_PDF_URL}\n\n"
-        txt += "Si quieres más dosieres, los añadiremos y te avisamos."
-        await q.edit_message_text(txt)
-        return
+    async def add(self, chat_id: int, query: str) -> int:
+        return await self._run(self._add, chat_id, query)
 
-    if data == "menu_contact":
-        await q.edit_message_text("Escribe el mensaje que quieres enviar al equipo (respuesta directa al admin).")
-        return CONTACT_MSG
+    async def delete(self, alert_id: int, chat_id: int) -> bool:
+        return await self._run(self._delete, alert_id, chat_id)
 
-    if data == "menu_back":
-        await q.edit_message_text("Menú principal. /start para volver.")
-        return
+    async def all(self):
+        return await self._run(self._all)
 
-    # search sub-options
-    if data == "search_sort_yield":
-        await q.edit_message_text("Buscando por rentabilidad (top 5)...")
-        await send_listings_sorted(context, q.from_user.id, sort_by="yield")
-        return
+class _AlertBucket:
+    # Alertas de una ciudad ("" = cualquiera), ordenadas por precio máximo y por yield mínimo:
+    # las que admiten un piso de precio P son un sufijo de by_max_price y las que admiten un
+    # yield Y, un prefijo de by_min_yield. Se comprueba el más corto de los dos.
+    __slots__ = ("by_max_price", "by_min_yield")
 
-    if data == "search_sort_price":
-        await q.edit_message_text("Buscando por precio (más barato, top 5)...")
-        await send_listings_sorted(context, q.from_user.id, sort_by="price")
-        return
+    def __init__(self):
+        self.by_max_price: List[Any] = []  # (precio máximo o INF, id)
+        self.by_min_yield: List[Any] = []  # (yield mínimo o -INF, id)
 
-    if data == "search_by_city":
-        await q.edit_message_text("Escribe el nombre de la ciudad que quieres buscar (ej: Madrid).")
-        # Next message will be handled by city_search_message
-        context.user_data["awaiting_city_search"] = True
-        return
+    @staticmethod
+    def keys(query: ListingQuery):
+        price = query.ranges.get("price", [None] * 4)[2]
+        yld = query.ranges.get("yield_pct", [None] * 4)[0]
+        return (INF if price is None else price), (-INF if yld is None else yld)
 
-    return
+    def add(self, alert_id: int, query: ListingQuery):
+        max_price, min_yield = self.keys(query)
+        bisect.insort(self.by_max_price, (max_price, alert_id))
+        bisect.insort(self.by_min_yield, (min_yield, alert_id))
 
-# ----------------------------
-# Enviar listados: leer sheet, calcular yield y ordenar
-# ----------------------------
-def safe_float(v):
-    try:
-        return float(str(v).replace(",", "").strip())
-    except Exception:
-        return None
+    def remove(self, alert_id: int, query: ListingQuery):
+        for order, key in zip((self.by_max_price, self.by_min_yield), self.keys(query)):
+            i = bisect.bisect_left(order, (key, alert_id))
+            if i < len(order) and order[i] == (key, alert_id):
+                del order[i]
 
-def parse_listing_row(row: List[str]) -> Dict[str, Any]:
-    # Our header expected:
-    # timestamp, chat_id, user, city, price, m2, rent_est, state, url, notes, photo_filename, contact
-    data = {}
-    data["timestamp"] = row[0] if len(row) > 0 else ""
-    data["chat_id"] = row[1] if len(row) > 1 else ""
-    data["user"] = row[2] if len(row) > 2 else ""
-    data["city"] = row[3] if len(row) > 3 else ""
-    data["price"] = safe_float(row[4]) if len(row) > 4 else None
-    data["m2"] = safe_float(row[5]) if len(row) > 5 else None
-    data["rent_est"] = safe_float(row[6]) if len(row) > 6 else None
-    data["state"] = row[7] if len(row) > 7 else ""
-    data["url"] = row[8] if len(row) > 8 else ""
-    data["notes"] = row[9] if len(row) > 9 else ""
-    data["photo"] = row[10] if len(row) > 10 else ""
-    data["contact"] = row[11] if len(row) > 11 else ""
-    # compute yield_net_approx = (rent_est * 12) / price * 100  (percent)
-    if data["price"] and data["rent_est"] and data["price"] != 0:
+    def candidates(self, l: Listing):
+        price = INF if l.price is None else l.price
+        yld = -INF if l.yield_pct is None else l.yield_pct
+        i = bisect.bisect_left(self.by_max_price, (price, -1))
+        j = bisect.bisect_right(self.by_min_yield, (yld, INF))
+        if len(self.by_max_price) - i <= j:
+            return _positions(self.by_max_price, i, len(self.by_max_price))
+        return _positions(self.by_min_yield, 0, j)
+
+class AlertIndex:
+    # Índice invertido ciudad -> _AlertBucket. Para un piso solo se miran dos buckets (su ciudad y
+    # "cualquiera") y dentro de cada uno el tramo que pasa los filtros de precio o de yield; el resto
+    # de filtros se comprueba con ListingQuery.matches sobre esos candidatos.
+
+    def __init__(self):
+        self.alerts: Dict[int, Any] = {}  # id -> (chat_id, ListingQuery)
+        self.buckets: Dict[str, _AlertBucket] = {}
+        self.by_chat: Dict[int, Dict[int, ListingQuery]] = {}  # chat_id -> {id: ListingQuery}
+
+    def add(self, alert_id: int, chat_id: int, query: ListingQuery):
+        self.alerts[alert_id] = (chat_id, query)
+        self.buckets.setdefault(query.city, _AlertBucket()).add(alert_id, query)
+        self.by_chat.setdefault(chat_id, {})[alert_id] = query
+
+    def remove(self, alert_id: int):
+        chat_id, query = self.alerts.pop(alert_id)
+        self.buckets[query.city].remove(alert_id, query)
+        mine = self.by_chat[chat_id]
+        del mine[alert_id]
+        if not mine:
+            del self.by_chat[chat_id]
+
+    def count(self, chat_id: int) -> int:
+        return len(self.by_chat.get(chat_id, ()))
+
+    def of_chat(self, chat_id: int) -> List[Any]:
+        return list(self.by_chat.get(chat_id, {}).items())
+
+    def match(self, l: Listing) -> List[int]:
+        found = []
+        city = normalize_city(l.city)
+        for key in {city, ""}:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                found += [i for i in bucket.candidates(l) if self.alerts[i][1].matches(l)]
+        return found
+
+class AlertService:
+    def __init__(self, db: AlertDB, per_user: int):
+        self.db = db
+        self.per_user = per_user
+        self.index = AlertIndex()
+        self._tasks = set()
+
+    async def start(self):
+        for alert_id, chat_id, query in await self.db.all():
+            try:
+                self.index.add(alert_id, chat_id, ListingQuery.parse(query))
+            except ValueError:
+                logger.warning("Alerta %s ilegible: %r", alert_id, query)
+
+    async def subscribe(self, chat_id: int, query: ListingQuery) -> int:
+        # ValueError con mensaje para el usuario si no se puede guardar
+        if not query:
+            raise ValueError("Elige al menos un filtro")
+        if self.index.count(chat_id) >= self.per_user:
+            raise ValueError(f"Como máximo puedes tener {self.per_user} alertas")
+        key = query.key()
+        if any(q.key() == key for _, q in self.index.of_chat(chat_id)):
+            raise ValueError("Ya tienes esa alerta")
+        alert_id = await self.db.add(chat_id, key)
+        self.index.add(alert_id, chat_id, query)
+        return alert_id
+
+    async def unsubscribe(self, alert_id: int, chat_id: int) -> bool:
+        if not await self.db.delete(alert_id, chat_id):
+            return False
+        self.index.remove(alert_id)
+        return True
+
+    def of_chat(self, chat_id: int) -> List[Any]:
+        return self.index.of_chat(chat_id)
+
+    def dispatch(self, listing: Listing, exclude=None):
+        # Se llama tras confirmar un piso y no espera nada: el aviso va en una tarea aparte y los
+        # mensajes salen por OUTBOX con sus límites de envío
+        task = asyncio.create_task(self._notify(listing, exclude))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _notify(self, listing: Listing, exclude):
         try:
-            data["yield"] = round((data["rent_est"] * 12) / data["price"] * 100, 2)
+            by_chat: Dict[int, List[str]] = {}
+            for alert_id in self.index.match(listing):
+                chat_id, query = self.index.alerts[alert_id]
+                if chat_id != exclude:
+                    by_chat.setdefault(chat_id, []).append(query.key())
+            body = render_listing(1, listing)
+            for chat_id, keys in by_chat.items():
+                names = ", ".join(f"«{k}»" for k in keys)
+                OUTBOX.submit(chat_id, f"🔔 Nuevo piso para tu alerta {names}:\n\n{body}", disable_web_page_preview=True)
+                M_ALERTS.inc()
         except Exception:
-            data["yield"] = None
-    else:
-        data["yield"] = None
-    return data
+            logger.exception("Error avisando alertas")
 
-async def send_listings_sorted(context: ContextTypes.DEFAULT_TYPE, chat_id, sort_by="yield"):
-    try:
-        ws = ensure_sheet()
-        rows = ws.get_all_records()
-    except Exception as e:
-        logger.exception("Error leyendo sheet para listados")
-        await context.bot.send_message(chat_id, "No puedo leer las oportunidades ahora. Revisa configuración.")
-        return
+M_ALERTS = METRICS.counter("r2r_alert_notifications_total", "Avisos de alertas enviados")
+ALERTS = AlertService(AlertDB(DB_PATH), ALERTS_PER_USER)
+METRICS.gauge("r2r_alerts", "Alertas guardadas", lambda: len(ALERTS.index.alerts))
 
-    listings = [parse_listing_row([
-        r.get("timestamp",""),
-        r.get("chat_id",""),
-        r.get("user",""),
-        r.get("city",""),
-        r.get("price",""),
-        r.get("m2",""),
-        r.get("rent_est",""),
-        r.get("state",""),
-        r.get("url",""),
-        r.get("notes",""),
-        r.get("photo_filename",""),
-        r.get("contact",""),
-    ]) for r in rows]
-
-    # filter out empty price and rent if sorting by yield
-    if sort_by == "yield":
-        listings = [l for l in listings if l.get("yield") is not None]
-        listings.sort(key=lambda x: (x.get("yield") is None, -(x.get("yield") or 0)))
-    elif sort_by == "price":
-        listings = [l for l in listings if l.get("price") is not None]
-        listings.sort(key=lambda x: (x.get("price") is None, x.get("price") or 0))
-    elif sort_by == "city":
-        listings.sort(key=lambda x: (x.get("city") or "").lower())
-
-    top = listings[:5]
-    if not top:
-        await context.bot.send_message(chat_id, "No hay listados disponibles con esos criterios.")
-        return
+def render_alerts(chat_id: int):
+    alerts = ALERTS.of_chat(chat_id)
+    if not alerts:
+        txt = "No tienes alertas. Crea una desde «Búsqueda con filtros» → 🔔 Crear alerta."
+    else:
+        txt = "🔔 Tus alertas (te aviso cuando llegue un piso que las cumpla):\n\n"
+        txt += "\n".join(f"{n}. {q.key()}" for n, (_, q) in enumerate(alerts, 1))
+    kb = [[InlineKeyboardButton(f"🗑 Borrar {n}", callback_data=f"al:del:{i}")] for n, (i, _) in enumerate(alerts, 1)]
+    kb.append([InlineKeyboardButton("Volver", callback_data="menu_search")])
+    return txt, InlineKeyboardMarkup(kb)
 
-    for l in top:
-        txt = f"🏠 {l.get('city') or '—'} · Precio: {l.get('price') or '—'}€ · m²: {l.get('m2') or '—'}\n"
-        if l.get("yield") is not None:
-            txt += f"📈 Yield aprox.: {l['yield']} %\n"
-        if l.get("url"):
-            txt += f"🔗 {l.get('url')}\n"
-        if l.get("contact"):
-            txt += f"📞 {l.get('contact')}\n"
-        txt += f"Publicado: {l.get('timestamp')}\n"
-        await context.bot.send_message(chat_id, txt)
+@timed
+async def alerts_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # al:new guarda los filtros del teclado como alerta, al:list las muestra, al:del:<id> borra una
+    q = update.callback_query
+    chat_id = q.message.chat.id
+    _, action, *rest = q.data.split(":", 2)
+    if action == "new":
+        try:
+            query = ListingQuery.parse(" ".join(context.user_data.get("search_draft", {}).values()))
+            if query.city:
+                # Sin corrección de erratas: si aún no hay pisos en esa ciudad se guarda tal cual
+                # se escribió (normalizada), no la ciudad más parecida que sí tenga
+                query.city = await resolve_city(query.city, fuzzy=False) or normalize_city(query.city)
+            await ALERTS.subscribe(chat_id, query)
+        except ValueError as e:
+            await q.answer(str(e), show_alert=True)
+            return
+        await q.answer("Alerta guardada 🔔")
+    elif action == "del" and rest and rest[0].isdigit():
+        await q.answer("Alerta borrada" if await ALERTS.unsubscribe(int(rest[0]), chat_id) else "Esa alerta ya no existe")
+    else:
+        await q.answer()
+    txt, markup = render_alerts(chat_id)
+    await q.edit_message_text(txt, reply_markup=markup)
 
 # ----------------------------
 # Conversational flow: "Vendo una casa" (en privado)
 # ----------------------------
+@timed
 async def c_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["city"] = update.message.text.strip()
     await update.message.reply_text("Precio (ej. 139000)")
     return C_PRICE
 
+@timed
 async def c_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["price"] = update.message.text.strip()
     await update.message.reply_text("Metros (m²)")
     return C_M2
 
+@timed
 async def c_m2(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["m2"] = update.message.text.strip()
     await update.message.reply_text("Alquiler estimado (€/mes)")
     return C_RENT
 
+@timed
 async def c_rent(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["rent"] = update.message.text.strip()
     await update.message.reply_text("Estado del piso (Reformado / A reformar)")
     return C_STATE
 
+@timed
 async def c_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["state"] = update.message.text.strip()
     await update.message.reply_text("Enlace al anuncio (si lo tienes) o escribe 'no'")
     return C_URL
 
+@timed
 async def c_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["url"] = update.message.text.strip()
     await update.message.reply_text("Puedes enviar una foto ahora o escribir 'no'")
     return C_PHOTO
 
+@timed
 async def c_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.photo:
-        file = await update.message.photo[-1].get_file()
-        fname = f"photo_{update.effective_user.id}_{int(datetime.utcnow().timestamp())}.jpg"
-        path = f"./uploads/{fname}"
-        os.makedirs("./uploads", exist_ok=True)
-        try:
-            await file.download_to_drive(path)
-            context.user_data["photo"] = path
-        except Exception:
-            logger.exception("Error descargando la foto")
-            context.user_data["photo"] = ""
+        # Guardamos el file_id (sirve para reenviarla sin volver a subirla); la descarga va aparte
+        size = update.message.photo[-1]
+        context.user_data["photo"] = size.file_id
+        await PHOTOS.enqueue(size.file_id, size.file_unique_id)
     else:
         context.user_data["photo"] = ""
     await update.message.reply_text("Contacto del propietario / tu contacto (teléfono o email) o 'no'")
     return C_CONTACT
 
+def submission_row(update: Update, s: Dict[str, Any], notes: str = "") -> List[Any]:
+    # Fila del envío en el orden de SHEET_HEADER
+    return [
+        datetime.utcnow().isoformat(),
+        update.effective_chat.id,
+        update.effective_user.username or update.effective_user.full_name,
+        s.get("city"),
+        s.get("price"),
+        s.get("m2"),
+        s.get("rent"),
+        s.get("state"),
+        s.get("url"),
+        notes,
+        s.get("photo", ""),
+        s.get("contact"),
+    ]
+
+def describe_listing(l: Listing) -> str:
+    return f"{l.city} · {fmt_num(l.price)}€ · {fmt_num(l.m2)} m² · {str(l.timestamp)[:10]}"
+
+def duplicate_warning(l: Listing) -> str:
+    same = DUPLICATES.same_url(l)
+    if same is not None:
+        return (
+            f"\n\n⚠️ Ese enlace ya está publicado ({describe_listing(same)}). "
+            "Si confirmas, no se crea otro anuncio: los datos nuevos se pasan a un admin para actualizarlo."
+        )
+    similar = DUPLICATES.similar(l)
+    if similar:
+        return "\n\n⚠️ Se parece a pisos ya publicados:\n" + "\n".join(f"- {describe_listing(o)}" for o in similar)
+    return ""
+
+@timed
 async def c_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["contact"] = update.message.text.strip()
     s = context.user_data
@@ -387,55 +3320,47 @@ async def c_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"URL: {s.get('url')}\n"
         f"Contacto: {s.get('contact')}"
     )
+    summary += duplicate_warning(Listing.from_row(submission_row(update, s)))
     await update.message.reply_text(summary + "\n\nConfirma 'si' para guardar o 'no' para cancelar.")
     return C_CONFIRM
 
+@timed
 async def c_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text.strip().lower()
     if txt in ("si", "sí", "s"):
         try:
-            ws = ensure_sheet()
             s = context.user_data
-            row = [
-                datetime.utcnow().isoformat(),
-                update.effective_chat.id,
-                update.effective_user.username or update.effective_user.full_name,
-                s.get("city"),
-                s.get("price"),
-                s.get("m2"),
-                s.get("rent"),
-                s.get("state"),
-                s.get("url"),
-                "",
-                s.get("photo", ""),
-                s.get("contact"),
-            ]
-            ws.append_row(row)
+            row = submission_row(update, s)
+            listing = Listing.from_row(row)
+            same = DUPLICATES.same_url(listing)
+            if same is not None:
+                # Mismo enlace: se guarda igualmente (los datos del vendedor no dependen de que el
+                # aviso llegue a un admin), marcado en notes para que un admin lo fusione. Sin
+                # alertas: para los suscriptores no es un piso nuevo.
+                row[9] = f"duplicado de {same.timestamp}"
+                await STORE.append(row)
+                await update.message.reply_text(
+                    "Ese anuncio ya estaba publicado. He guardado tus datos y un admin "
+                    "actualizará el existente si ha cambiado algo."
+                )
+                notify_admins(
+                    f"Envío repetido de {update.effective_user.full_name}: {s.get('url')}\n"
+                    f"Publicado: {describe_listing(same)}\nNuevo: {describe_listing(listing)}"
+                )
+                return ConversationHandler.END
+            if DUPLICATES.similar(listing):
+                row[9] = "posible duplicado"
+            # Queda en el diario local; la subida a Sheets se hace en segundo plano
+            await STORE.append(row)
             await update.message.reply_text("Guardado. Gracias — un admin lo revisará y lo publicará si procede.")
-            # Notificar admin principal (ADMIN_NOTIFY) del nuevo piso ofrecido
-            try:
-                target = ADMIN_NOTIFY
-                # si es un id numérico
-                if str(target).isdigit():
-                    await context.bot.send_message(int(target), f"nuevo piso ofrecido · {s.get('city')} · {s.get('price')}")
-                else:
-                    await context.bot.send_message(target, f"nuevo piso ofrecido · {s.get('city')} · {s.get('price')}")
-            except Exception:
-                logger.exception("Error notificando admin via ADMIN_NOTIFY")
-            # Notificar también los ADMIN_IDS si hay
-            for a in ADMIN_IDS:
-                try:
-                    await context.bot.send_message(a, f"Nuevo piso ofrecido por {update.effective_user.full_name}: {s.get('city')} {s.get('price')}")
-                except Exception:
-                    logger.exception("Error notificando admin id")
+            # Notificar admin principal (ADMIN_NOTIFY) y los ADMIN_IDS en paralelo, sin esperar
+            OUTBOX.submit(admin_notify_target(), f"nuevo piso ofrecido · {s.get('city')} · {s.get('price')}")
+            notify_admins(f"Nuevo piso ofrecido por {update.effective_user.full_name}: {s.get('city')} {s.get('price')}")
+            ALERTS.dispatch(listing, exclude=update.effective_chat.id)
         except Exception as e:
-            logger.exception("Error guardando en sheet")
+            logger.exception("Error guardando el envío")
             await update.message.reply_text("Hubo un problema guardando el piso. Avisaré a un admin para que lo revise.")
-            for a in ADMIN_IDS:
-                try:
-                    await context.bot.send_message(a, f"Error guardando envío: {e}")
-                except Exception:
-                    pass
+            ERRORS.record(e)
     else:
         await update.message.reply_text("Cancelado.")
     return ConversationHandler.END
@@ -443,97 +3368,281 @@ async def c_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ----------------------------
 # Contacto: recoger texto y reenviar al admin
 # ----------------------------
+@timed
 async def contact_message_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Entrada desde menu "Contacto" - ya handled returning CONTACT_MSG
     await update.message.reply_text("Escribe el mensaje que quieres que recibamos (responderemos por privado).")
     return CONTACT_MSG
 
+@timed
 async def contact_message_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     sender = update.effective_user
     try:
-        target = ADMIN_NOTIFY
         forward_text = f"Mensaje de contacto de @{sender.username or sender.full_name} ({sender.id}):\n\n{text}"
-        if str(target).isdigit():
-            await context.bot.send_message(int(target), forward_text)
-        else:
-            await context.bot.send_message(target, forward_text)
+        await OUTBOX.send(admin_notify_target(), forward_text)
         await update.message.reply_text("Mensaje enviado. Gracias, te responderemos por privado si procede.")
     except Exception:
         logger.exception("Error reenviando mensaje de contacto")
         await update.message.reply_text("No he podido reenviar el mensaje. Avisaré a los admins.")
-        for a in ADMIN_IDS:
-            try:
-                await context.bot.send_message(a, f"Error reenviando mensaje contacto de {sender.id}: {text}")
-            except Exception:
-                pass
+        notify_admins(f"Error reenviando mensaje contacto de {sender.id}: {text}")
     return ConversationHandler.END
 
 # ----------------------------
 # Admin command: lista (últimos envíos)
 # ----------------------------
+@timed
 async def admin_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return await update.message.reply_text("No autorizado")
     try:
-        ws = ensure_sheet()
-        rows = ws.get_all_records()[-10:]
-        txt = "Últimos envíos:\n"
+        rows = await STORE.latest(10)
+        txt = "Últimos envíos:\n" + cached_note()
         for r in rows:
-            txt += f"- {r.get('timestamp','')} | {r.get('user','')} | {r.get('city','')} | {r.get('price','')}€\n"
+            txt += f"- {r.timestamp} | {r.user} | {r.city} | {fmt_num(r.price)}€\n"
         await update.message.reply_text(txt)
     except Exception as e:
         logger.exception("Error en admin_list")
         await update.message.reply_text("Error leyendo la hoja. Revisa permisos y SPREADSHEET_ID.")
 
+# ----------------------------
+# Admin command: stats (resumen de métricas)
+# ----------------------------
+def _ms(v) -> str:
+    return "—" if v is None else f"{v * 1000:.0f}ms"
+
+def render_stats() -> str:
+    uptime = int(time.monotonic() - STARTED_AT)
+    hits = M_CACHE.values.get(("hit",), 0)
+    reads = M_CACHE.total()
+    txt = f"📊 Estadísticas (uptime {uptime // 3600}h{uptime % 3600 // 60:02d}m)\n\n"
+    txt += "Handlers (llamadas · p50 · p95 · errores):\n"
+    by_calls = sorted(M_HANDLER_SECONDS.values.items(), key=lambda kv: -sum(kv[1][:-1]))
+    for (name,), v in by_calls[:8]:
+        p50 = M_HANDLER_SECONDS.quantile(0.5, name)
+        p95 = M_HANDLER_SECONDS.quantile(0.95, name)
+        txt += f"- {name}: {int(sum(v[:-1]))} · {_ms(p50)} · {_ms(p95)} · {int(M_HANDLER_ERRORS.values.get((name,), 0))}\n"
+    ok = sum(v for (op, res), v in M_SHEETS_CALLS.values.items() if res == "ok")
+    txt += (
+        f"\nSheets: {int(M_SHEETS_CALLS.total())} llamadas ({int(M_SHEETS_CALLS.total() - ok)} con error), "
+        f"{M_SHEETS_BYTES.total() / 1024:.0f} KiB recibidos\n"
+        f"Circuito Sheets: {SHEET_STORAGE.breaker.state}, {int(M_SHEETS_RETRIES.total())} reintentos\n"
+        f"Caché: {int(reads)} lecturas, {100 * hits / reads if reads else 0:.0f}% aciertos\n"
+        f"Telegram: {OUTBOX.sent} enviados, {OUTBOX.retries} reintentos, "
+        f"p95 {_ms(M_TG_SECONDS.quantile(0.95, 'send_message'))}\n"
+        f"Colas: envíos {OUTBOX.depth} · fotos {PHOTOS.depth} · pendientes de Sheets {len(LISTINGS._pending)}\n"
+    )
+    return txt
+
+@timed
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return await update.message.reply_text("No autorizado")
+    await update.message.reply_text(render_stats())
+
+# ----------------------------
+# Admin command: mercado (estadísticas por ciudad)
+# ----------------------------
+def _bar(n: int, top: int, width: int = 12) -> str:
+    return "█" * max(1 if n else 0, round(width * n / top)) if top else ""
+
+def render_market_city(name: str, agg: MarketAggregate, months: int = 6) -> str:
+    txt = (
+        f"🏙 {name} · {agg.n} anuncios\n"
+        f"Precio mediano: {fmt_num(median(agg.prices)) or '—'}€ · "
+        f"€/m² mediano: {fmt_num(round(median(agg.ppm2))) if agg.ppm2 else '—'} · "
+        f"yield mediano: {fmt_num(median(agg.yields)) or '—'} %\n\nYield:\n"
+    )
+    labels = [f"<{YIELD_BINS[0]}%"] + [f"{a}-{b}%" for a, b in zip(YIELD_BINS, YIELD_BINS[1:])] + [f"≥{YIELD_BINS[-1]}%"]
+    top = max(agg.yield_hist)
+    for label, n in zip(labels, agg.yield_hist):
+        txt += f"{label:>6} {_bar(n, top)} {n}\n"
+    recent = sorted(agg.months.items())[-months:]
+    if recent:
+        top = max(n for _, n in recent)
+        txt += "\nEnvíos por mes:\n"
+        for month, n in recent:
+            txt += f"{month} {_bar(n, top)} {n}\n"
+    return txt
+
+def render_market(limit: int = 10) -> str:
+    txt = render_market_city("Total", MARKET.total) + "\nPor ciudad (anuncios · precio mediano · €/m² · yield):\n"
+    cities = sorted(MARKET.by_city.items(), key=lambda kv: -kv[1].n)
+    for city, agg in cities[:limit]:
+        ppm2 = fmt_num(round(median(agg.ppm2))) if agg.ppm2 else "—"
+        txt += (
+            f"- {MARKET.display.get(city) or '—'}: {agg.n} · {fmt_num(median(agg.prices)) or '—'}€ · "
+            f"{ppm2} · {fmt_num(median(agg.yields)) or '—'} %\n"
+        )
+    if len(cities) > limit:
+        txt += f"… y {len(cities) - limit} ciudades más (/mercado <ciudad>)\n"
+    return txt
+
+@timed
+async def admin_market(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return await update.message.reply_text("No autorizado")
+    query = " ".join(context.args or [])
+    try:
+        # También refresca la caché si ha caducado (los agregados se actualizan con ella)
+        city = await resolve_city(query) if query else None
+        if query and city is None:
+            return await update.message.reply_text(f"No hay anuncios en {query}.")
+        if city:
+            txt = render_market_city(MARKET.display.get(city, city), MARKET.by_city[city], months=12)
+        else:
+            await STORE.cities()
+            txt = render_market()
+        txt = cached_note() + txt
+    except Exception:
+        logger.exception("Error en admin_market")
+        return await update.message.reply_text("No puedo leer las oportunidades ahora.")
+    await update.message.reply_text(txt)
+
+# ----------------------------
+# Admin command: export (CSV / JSONL de todo el catálogo, por bloques)
+# ----------------------------
+EXPORT_USAGE = "Uso: /export [csv|jsonl] [ciudad=<nombre>] [desde=AAAA-MM-DD] [hasta=AAAA-MM-DD]"
+EXPORT_FIELDS = list(SHEET_HEADER) + ["yield_pct"]
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # límite de subida de documentos de la Bot API
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+def parse_export_args(args: List[str]):
+    # -> (formato, ciudad, desde, hasta); ValueError con el mensaje para el usuario
+    fmt, city, since, until = "csv", "", "", ""
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        key = key.lower()
+        if not sep and key in ("csv", "jsonl"):
+            fmt = key
+        elif key == "ciudad" and value:
+            city = value.replace("_", " ")
+        elif key in ("desde", "hasta") and _DATE_RE.match(value):
+            if key == "desde":
+                since = value
+            else:
+                until = value
+        else:
+            raise ValueError(f"No entiendo «{arg}».\n{EXPORT_USAGE}")
+    return fmt, city, since, until
+
+async def export_listings(chunks, city_norm: str = "", since: str = "", until: str = ""):
+    # Filtra los bloques de STORE.iter_chunks sin juntarlos: los timestamps son ISO, así que las
+    # fechas se comparan como texto por los 10 primeros caracteres
+    async for chunk in chunks:
+        for l in chunk:
+            if city_norm and normalize_city(l.city) != city_norm:
+                continue
+            day = str(l.timestamp)[:10]
+            if (since and day < since) or (until and day > until):
+                continue
+            yield l
+
+def export_row(l: Listing) -> List[Any]:
+    return l.as_row() + [None if l.yield_pct is None else round(l.yield_pct, 2)]
+
+def csv_lines():
+    # Generador de líneas CSV: se le envía una fila con send() y devuelve su texto ya escapado
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    row = yield
+    while True:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(row)
+        row = yield buf.getvalue()
+
+async def write_export(out, rows, fmt: str) -> int:
+    # Escribe el encabezado y cada anuncio según llega; devuelve cuántos se han escrito
+    n = 0
+    if fmt == "csv":
+        line = csv_lines()
+        next(line)
+        out.write(line.send(EXPORT_FIELDS))
+        async for l in rows:
+            out.write(line.send([fmt_num(v) if v is None or isinstance(v, float) else v for v in export_row(l)]))
+            n += 1
+    else:
+        async for l in rows:
+            out.write(json.dumps(dict(zip(EXPORT_FIELDS, export_row(l))), ensure_ascii=False))
+            out.write("\n")
+            n += 1
+    return n
+
+@timed
+async def admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return await update.message.reply_text("No autorizado")
+    try:
+        fmt, city, since, until = parse_export_args(context.args or [])
+    except ValueError as e:
+        return await update.message.reply_text(str(e))
+    chat_id = update.effective_chat.id
+    # Hasta EXPORT_SPOOL bytes en memoria y a partir de ahí en disco: con la hoja leída por
+    # bloques de EXPORT_CHUNK filas, la memoria no depende del tamaño del catálogo
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL) as raw:
+        try:
+            out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            rows = export_listings(STORE.iter_chunks(EXPORT_CHUNK), normalize_city(city), since, until)
+            n = await write_export(out, rows, fmt)
+            out.flush()
+            out.detach()
+        except Exception:
+            logger.exception("Error en admin_export")
+            return await update.message.reply_text("No puedo leer los anuncios ahora.")
+        size = raw.tell()
+        if size > EXPORT_MAX_BYTES:
+            return await update.message.reply_text(
+                f"La exportación ocupa {size // (1024 * 1024)} MB y Telegram admite 50 MB. Filtra por ciudad o fechas."
+            )
+        raw.seek(0)
+        name = "_".join(["anuncios"] + [v.replace(" ", "-") for v in (normalize_city(city), since, until) if v])
+        # python-telegram-bot sube los documentos desde memoria: el fichero solo se lee entero aquí,
+        # una vez, y el InputFile se reutiliza si OUTBOX reintenta el envío
+        document = InputFile(raw.read(), filename=f"{name}.{fmt}")
+    caption = f"{n} anuncios" + (f" en {city}" if city else "")
+    try:
+        await OUTBOX.send(chat_id, method="send_document", document=document, caption=caption)
+    except Exception:
+        logger.exception("Error enviando la exportación")
+        await update.message.reply_text("No he podido enviar el fichero.")
+
 # ----------------------------
 # City search if user typed a city after clicking "Buscar por ciudad"
 # ----------------------------
+@timed
 async def city_search_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.pop("awaiting_filter_city", False):
+        # Ciudad pedida desde el teclado de filtros: se añade al borrador y se busca
+        draft = context.user_data.setdefault("search_draft", {})
+        draft["ciudad"] = "ciudad=" + "_".join(update.message.text.split())
+        try:
+            query = ListingQuery.parse(" ".join(draft.values()))
+        except ValueError as e:
+            del draft["ciudad"]
+            await update.message.reply_text(f"{e}.")
+            return
+        await search_and_reply(context, update.effective_chat.id, query)
+        return
     if not context.user_data.get("awaiting_city_search"):
         return
     city = update.message.text.strip().lower()
     context.user_data["awaiting_city_search"] = False
-    # read sheet and filter by city
+    # índice de ciudades del snapshot (sin acentos ni mayúsculas)
     try:
-        ws = ensure_sheet()
-        rows = ws.get_all_records()
+        resolved = await resolve_city(city)
+        found = resolved is not None and await send_page(update.effective_chat.id, "c", resolved)
     except Exception as e:
         logger.exception("Error leyendo sheet para búsqueda por ciudad")
         await update.message.reply_text("No puedo leer las oportunidades ahora. Revisa configuración.")
         return
-    results = []
-    for r in rows:
-        if str(r.get("city","")).strip().lower() == city:
-            results.append(parse_listing_row([
-                r.get("timestamp",""),
-                r.get("chat_id",""),
-                r.get("user",""),
-                r.get("city",""),
-                r.get("price",""),
-                r.get("m2",""),
-                r.get("rent_est",""),
-                r.get("state",""),
-                r.get("url",""),
-                r.get("notes",""),
-                r.get("photo_filename",""),
-                r.get("contact",""),
-            ]))
-    if not results:
+    if not found:
         await update.message.reply_text(f"No he encontrado listados para {city.capitalize()}.")
-        return
-    # show up to 5
-    for l in results[:5]:
-        txt = f"🏠 {l.get('city')} · Precio: {l.get('price') or '—'}€ · m²: {l.get('m2') or '—'}\n"
-        if l.get("yield") is not None:
-            txt += f"📈 Yield aprox.: {l['yield']} %\n"
-        if l.get("url"):
-            txt += f"🔗 {l.get('url')}\n"
-        await update.message.reply_text(txt)
 
 # ----------------------------
 # Welcome new members
 # ----------------------------
+@timed
 async def welcome_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     for member in update.message.new_chat_members:
@@ -563,21 +3672,356 @@ async def welcome_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE
             pass
 
 # ----------------------------
-# Error handler
+# Error handler: log estructurado + resumen periódico a los admins
 # ----------------------------
+def error_origin(exc: BaseException) -> str:
+    # Primera función de este fichero en el traceback: el handler al que PTB pasó el update
+    for frame, _ in traceback.walk_tb(exc.__traceback__):
+        if frame.f_code.co_filename == __file__ and frame.f_code.co_name != "_timed":
+            return frame.f_code.co_name
+    return "?"
+
+class ErrorDigest:
+    # Agrupa los errores por (tipo de excepción, handler) y cada `interval` segundos manda un único
+    # resumen a los admins con el recuento, primera y última vez y un traceback de ejemplo. Así una
+    # caída de Sheets no genera un mensaje por clic y por admin.
+
+    def __init__(self, interval: float, samples: int):
+        self.interval = interval
+        self.samples = samples
+        self._groups: Dict[Any, Dict[str, Any]] = {}
+        self._task = None
+
+    def record(self, exc: BaseException, origin: str = None):
+        key = (type(exc).__name__, origin or error_origin(exc))
+        now = datetime.utcnow()
+        g = self._groups.get(key)
+        if g is None:
+            g = self._groups[key] = {"count": 0, "first": now, "samples": []}
+        g["count"] += 1
+        g["last"] = now
+        if len(g["samples"]) < self.samples:
+            tb = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+            g["samples"].append(tb[-700:])
+
+    def render(self, groups) -> str:
+        txt = f"⚠️ Errores en los últimos {int(self.interval // 60) or 1} min:\n"
+        for (etype, origin), g in sorted(groups.items(), key=lambda kv: -kv[1]["count"]):
+            txt += (
+                f"\n• {etype} en {origin} ×{g['count']} "
+                f"(primero {g['first']:%H:%M:%S}, último {g['last']:%H:%M:%S} UTC)\n"
+            )
+            for tb in g["samples"]:
+                txt += tb + "\n"
+        return txt[:4000]
+
+    def flush(self):
+        groups, self._groups = self._groups, {}
+        if groups:
+            notify_admins(self.render(groups))
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.flush()
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+ERRORS = ErrorDigest(ERROR_DIGEST_INTERVAL, ERROR_DIGEST_SAMPLES)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
-    logger.error("Exception", exc_info=context.error)
-    for a in ADMIN_IDS:
+    exc = context.error
+    origin = error_origin(exc)
+    info = {"event": "handler_error", "type": type(exc).__name__, "handler": origin, "error": str(exc)}
+    if isinstance(update, Update):
+        info["update_id"] = update.update_id
+        info["chat_id"] = update.effective_chat.id if update.effective_chat else None
+        info["user_id"] = update.effective_user.id if update.effective_user else None
+    logger.error(json.dumps(info, ensure_ascii=False), exc_info=exc)
+    ERRORS.record(exc, origin)
+
+# ----------------------------
+# Arranque / parada de tareas de fondo
+# ----------------------------
+def health(app):
+    ok = app.running
+    body = json.dumps({
+        "status": "ok" if ok else "starting",
+        "mode": "webhook" if WEBHOOK_URL else "polling",
+        "uptime_s": round(time.monotonic() - STARTED_AT),
+        "send_queue": OUTBOX.depth,
+        "sheets_circuit": SHEET_STORAGE.breaker.state,
+        "startup_ms": {k: round(v * 1000) for k, v in STARTUP_PHASES.items()},
+    })
+    return (200 if ok else 503), "application/json", body
+
+METRICS.gauge("r2r_send_queue_depth", "Mensajes pendientes en la cola de envíos", lambda: OUTBOX.depth)
+METRICS.gauge("r2r_photo_queue_depth", "Fotos pendientes de descargar", lambda: PHOTOS.depth)
+METRICS.gauge("r2r_sheets_pending_rows", "Envíos pendientes de subir a Sheets", lambda: len(LISTINGS._pending))
+METRICS.gauge("r2r_listings_cached", "Anuncios en la caché", lambda: len(LISTINGS.listings))
+METRICS.gauge(
+    "r2r_sheets_circuit_state", "Circuito de Google Sheets: 0 cerrado, 1 semiabierto, 2 abierto",
+    lambda: CircuitBreaker.STATES.index(SHEET_STORAGE.breaker.state),
+)
+
+# Fases del arranque (segundos), para el log y /healthz
+STARTUP_PHASES: Dict[str, float] = {}
+
+async def startup_phase(name: str, coro, required: bool = False):
+    # Las fases de calentamiento pueden fallar sin impedir el arranque; las required no
+    t0 = time.perf_counter()
+    try:
+        return await coro
+    except Exception:
+        if required:
+            raise
+        logger.exception("Arranque: fallo en %s (se reintentará bajo demanda)", name)
+    finally:
+        STARTUP_PHASES[name] = time.perf_counter() - t0
+
+async def warm_up(app):
+    # Lo que antes pagaba el primer usuario tras un despliegue: get_me, autorizar y abrir la hoja,
+    # y el primer snapshot de anuncios con su índice de ciudades. get_me va en paralelo con Sheets.
+    async def sheets():
+        if STORAGE_BACKEND != "sqlite" or SHEETS_MIRROR:
+            await startup_phase("sheets_auth", SHEET_STORAGE.connect())
+        await startup_phase("store_start", STORE.start(), required=True)
+        await startup_phase("snapshot", STORE.cities())
+
+    await asyncio.gather(
+        startup_phase("get_me", get_bot_username(app)),
+        startup_phase("alerts", ALERTS.start(), required=True),
+        sheets(),
+    )
+
+def log_startup():
+    total = time.perf_counter() - _IMPORT_T0
+    phases = " · ".join(f"{k} {v * 1000:.0f} ms" for k, v in STARTUP_PHASES.items())
+    logger.info("Arranque listo en %.0f ms (%s)", total * 1000, phases)
+
+async def post_init(app):
+    METRICS.gauge("r2r_update_queue_depth", "Updates pendientes de procesar", app.update_queue.qsize)
+    OUTBOX.start(app.bot)
+    await PHOTOS.start(app.bot)
+    ERRORS.start()
+    await warm_up(app)
+    OPS.route("/healthz", lambda: health(app))
+    OPS.route("/metrics", lambda: (200, "text/plain; version=0.0.4", METRICS.render()))
+    await OPS.start()
+    log_startup()
+
+async def post_stop(app):
+    # Antes de cerrar el bot: último resumen de errores, que salga lo que quede en la cola y
+    # terminen las descargas
+    ERRORS.stop()
+    await OUTBOX.stop()
+    await PHOTOS.stop()
+
+async def post_shutdown(app):
+    await OPS.stop()
+    await STORE.stop()
+
+# ----------------------------
+# Persistencia de conversaciones y user_data (SQLite, escrituras agrupadas)
+# ----------------------------
+class StateDB(SQLiteThread):
+    schema = [
+        "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS conversations ("
+        "name TEXT NOT NULL, conv_key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, conv_key))",
+    ]
+
+    def __init__(self, path: str):
+        super().__init__(path, "state-db")
+
+    def _load_user_data(self):
+        return {uid: json.loads(data) for uid, data in self._db().execute("SELECT user_id, data FROM user_data")}
+
+    def _load_conversations(self, name: str):
+        cur = self._db().execute("SELECT conv_key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(k)): json.loads(st) for k, st in cur}
+
+    def _write(self, users: Dict[int, Any], convs: Dict[Any, Any]):
+        # Un valor None significa borrar
+        db = self._db()
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                [(uid, data) for uid, data in users.items() if data is not None],
+            )
+            db.executemany("DELETE FROM user_data WHERE user_id = ?", [(uid,) for uid, d in users.items() if d is None])
+            db.executemany(
+                "INSERT OR REPLACE INTO conversations (name, conv_key, state) VALUES (?, ?, ?)",
+                [(name, key, st) for (name, key), st in convs.items() if st is not None],
+            )
+            db.executemany(
+                "DELETE FROM conversations WHERE name = ? AND conv_key = ?",
+                [(name, key) for (name, key), st in convs.items() if st is None],
+            )
+
+    async def load_user_data(self):
+        return await self._run(self._load_user_data)
+
+    async def load_conversations(self, name: str):
+        return await self._run(self._load_conversations, name)
+
+    async def write(self, users: Dict[int, Any], convs: Dict[Any, Any]):
+        await self._run(self._write, users, convs)
+
+class SQLitePersistence(BasePersistence):
+    # Solo guarda user_data y el estado de las conversaciones. PTB entrega los cambios cada
+    # PERSIST_INTERVAL segundos; aquí se acumulan y se escriben solo las filas modificadas, en una
+    # única transacción tras PERSIST_DEBOUNCE segundos (nada de reescribir un pickle entero).
+    # Al arrancar se carga todo con una consulta por tabla.
+
+    def __init__(self, path: str, update_interval: float, debounce: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = StateDB(path)
+        self.debounce = debounce
+        self._users: Dict[int, Any] = {}
+        self._convs: Dict[Any, Any] = {}
+        self._flush_task = None
+
+    def _schedule(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_write())
+
+    async def _delayed_write(self):
+        await asyncio.sleep(self.debounce)
+        await self._write()
+
+    async def _write(self):
+        users, self._users = self._users, {}
+        convs, self._convs = self._convs, {}
+        if users or convs:
+            await self.db.write(users, convs)
+
+    async def get_user_data(self):
+        return await self.db.load_user_data()
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        return await self.db.load_conversations(name)
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        self._convs[(name, json.dumps(list(key)))] = None if new_state is None else json.dumps(new_state)
+        self._schedule()
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        self._users[user_id] = json.dumps(data, ensure_ascii=False, default=str)
+        self._schedule()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._users[user_id] = None
+        self._schedule()
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write()
+
+# ----------------------------
+# Procesado concurrente de updates con orden por usuario/chat
+# ----------------------------
+def update_order_key(update: object):
+    # Los updates con la misma clave (chat, usuario) se procesan en orden; es la misma clave que
+    # usan sell_conv y contact_conv para guardar el estado de la conversación.
+    if not isinstance(update, Update):
+        return None
+    chat, user = update.effective_chat, update.effective_user
+    if chat is None and user is None:
+        return None
+    return (chat.id if chat else None, user.id if user else None)
+
+class OrderedApplication(Application):
+    # Con concurrent_updates PTB lanza cada update en su propia tarea, en orden de llegada. Aquí
+    # cada tarea espera al lock de su clave antes de pasar por los handlers: usuarios distintos
+    # van en paralelo (hasta UPDATE_CONCURRENCY) y los updates de un mismo usuario, en fila.
+    # asyncio.Lock despierta a los que esperan en orden FIFO, que es el orden de llegada.
+    # PTB toma su semáforo antes de llamar a process_update, así que un update esperando turno
+    # ocupa uno de sus huecos: por eso su límite es UPDATE_BACKLOG (amplio) y el de trabajo real,
+    # UPDATE_CONCURRENCY, es un semáforo propio que se toma después del lock de la clave. Una
+    # ráfaga de un usuario no quita huecos a los demás.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._order_locks: Dict[Any, Any] = {}  # clave -> [lock, tareas que lo usan]
+        self._slots = asyncio.Semaphore(max(1, UPDATE_CONCURRENCY))
+
+    async def process_update(self, update: object) -> None:
+        if not self.concurrent_updates:
+            return await super().process_update(update)
+        key = update_order_key(update)
+        if key is None:
+            async with self._slots:
+                return await super().process_update(update)
+        entry = self._order_locks.get(key)
+        if entry is None:
+            entry = self._order_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
         try:
-            await context.bot.send_message(a, f"Error en bot: {context.error}")
-        except Exception:
-            pass
+            async with entry[0], self._slots:
+                await super().process_update(update)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._order_locks[key]
 
 # ----------------------------
 # Build app and handlers
 # ----------------------------
 def build_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .application_class(OrderedApplication)
+        .concurrent_updates(max(UPDATE_BACKLOG, UPDATE_CONCURRENCY) if UPDATE_CONCURRENCY > 1 else False)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if PERSISTENCE:
+        builder = builder.persistence(SQLitePersistence(DB_PATH, PERSIST_INTERVAL, PERSIST_DEBOUNCE))
+    app = builder.build()
 
     # Conversation handler for selling (entry via callback menu 'menu_sell')
     sell_conv = ConversationHandler(
@@ -600,6 +4044,8 @@ def build_app():
             )
         ],
         allow_reentry=True,
+        name="sell_conv",
+        persistent=PERSISTENCE,
     )
 
     # Conversation handler for contact messages (entry via callback menu 'menu_contact')
@@ -615,6 +4061,8 @@ def build_app():
             )
         ],
         allow_reentry=True,
+        name="contact_conv",
+        persistent=PERSISTENCE,
     )
 
     # Register handlers
@@ -623,8 +4071,16 @@ def build_app():
     app.add_handler(contact_conv)
     # CallbackQueryHandler para search subcommands y manual/menu handling
     app.add_handler(CallbackQueryHandler(callback_menu, pattern=r"^menu_|^search_|^menu_back$"))
+    app.add_handler(CallbackQueryHandler(page_callback, pattern=r"^pg:"))
+    app.add_handler(CallbackQueryHandler(photos_callback, pattern=r"^ph:"))
+    app.add_handler(CallbackQueryHandler(filter_callback, pattern=r"^flt:"))
+    app.add_handler(CallbackQueryHandler(alerts_callback, pattern=r"^al:"))
     app.add_handler(CommandHandler("lista", admin_list))
-    app.add_handler(MessageHandler(filters.Regex(r"^/[a-zA-ZñÑáéíóúÁÉÍÓÚ]+$"), city_command_handler := (lambda u,c: city_handler(u,c))))
+    app.add_handler(CommandHandler("stats", admin_stats))
+    app.add_handler(CommandHandler("mercado", admin_market))
+    app.add_handler(CommandHandler("export", admin_export))
+    app.add_handler(CommandHandler("buscar", search_command))
+    app.add_handler(MessageHandler(filters.Regex(r"^/[a-zA-ZñÑáéíóúÁÉÍÓÚüÜ_]+(@\w+)?$"), city_handler))
     # handler para texto luego de "Buscar por ciudad"
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, city_search_message))
     app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_new_members))
@@ -633,17 +4089,47 @@ def build_app():
     return app
 
 # small wrapper to satisfy city command usage
+@timed
 async def city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     txt = update.message.text
     if not txt.startswith("/"):
         return
-    city = txt[1:].strip()
-    await update.message.reply_text(f"Buscando oportunidades en {city.capitalize()}... (próximamente).")
+    # /madrid, /san_sebastian, /malaga@NombreDelBot
+    city = txt[1:].split("@", 1)[0].strip().replace("_", " ")
+    try:
+        reply, markup = await city_reply(city)
+    except Exception:
+        logger.exception("Error buscando /%s", city)
+        reply, markup = "No puedo leer las oportunidades ahora. Prueba en un rato.", None
+    OUTBOX.submit(
+        update.effective_chat.id,
+        reply,
+        reply_markup=markup,
+        reply_to_message_id=update.message.message_id,
+        disable_web_page_preview=True,
+    )
 
 # ----------------------------
 # Entrypoint
 # ----------------------------
 if __name__ == "__main__":
     logger.info("Starting Ready2R Bot (full menu)...")
+    STARTUP_PHASES["import"] = time.perf_counter() - _IMPORT_T0
+    t0 = time.perf_counter()
+    # La conexión con Google Sheets se hace en post_init (warm_up), en paralelo con get_me
     app = build_app()
-    app.run_polling(poll_interval=3)
+    STARTUP_PHASES["build_app"] = time.perf_counter() - t0
+    if WEBHOOK_URL:
+        # Telegram empuja las actualizaciones al servidor webhook integrado (tornado). Para probar en
+        # local basta con hacer POST de un Update JSON a http://localhost:WEBHOOK_PORT/WEBHOOK_PATH
+        # (con la cabecera X-Telegram-Bot-Api-Secret-Token si hay WEBHOOK_SECRET).
+        logger.info("Modo webhook en %s:%s/%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling(poll_interval=3)
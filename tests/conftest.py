@@ -0,0 +1,10 @@
+# tests/conftest.py
+# Los tests usan los mismos sustitutos en memoria que los benchmarks (benchmarks/fakes.py), que
+# fijan el entorno (token falso, datos en un directorio temporal) antes de importar bot_pro.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+import fakes  # noqa: E402,F401
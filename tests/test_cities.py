@@ -0,0 +1,54 @@
+# tests/test_cities.py
+# CityMatcher: prefijos, erratas de una letra y su mantenimiento como suscriptor del catálogo.
+
+import asyncio
+import os
+import tempfile
+
+from fakes import bot_pro
+
+
+def listing(city):
+    return bot_pro.Listing(city=city, price=100000, rent_est=600)
+
+
+def test_osa_distance_counts_a_transposition_as_one_edit():
+    assert bot_pro.osa_distance("madird", "madrid") == 1
+    assert bot_pro.osa_distance("madrid", "madrid") == 0
+    assert bot_pro.osa_distance("sevila", "sevilla") == 1
+    assert bot_pro.osa_distance("abcd", "badc") == 2
+    assert bot_pro.osa_distance("", "abc") == 3
+
+
+def test_resolve_exact_prefix_and_one_typo():
+    m = bot_pro.CityMatcher({"madrid": 5, "sevilla": 3, "palencia": 1, "zaragoza": 2})
+    assert m.resolve("Madrid") == "madrid"
+    assert m.resolve("sev") == "sevilla"
+    assert m.resolve("sevila") == "sevilla"
+    assert m.resolve("zaragosa") == "zaragoza"
+    assert m.resolve("madird") == "madrid"  # letras contiguas intercambiadas
+    assert m.resolve("sveilla") == "sevilla"
+    assert m.resolve("valencia") is None  # otra ciudad, no una errata de palencia
+    assert m.resolve("zaragosa", fuzzy=False) is None
+
+
+def test_sqlite_store_keeps_matcher_current_without_querying_cities():
+    async def main():
+        store = bot_pro.SQLiteListingStore(os.path.join(tempfile.mkdtemp(), "listings.db"))
+        matcher = bot_pro.CityMatcher({})
+        store.subscribe(matcher)
+        await store._run(store._insert, [listing("Madrid"), listing("Madrid"), listing("Sevilla")])
+        await store.start()
+        queried = []
+        store._cities = lambda: queried.append(1) or {}
+        before = matcher.resolve("teruel")
+        await store.append(listing("Teruel").as_row())
+        await store.append(listing("Madrid").as_row())
+        return matcher.counts, before, matcher.resolve("teruel"), matcher.resolve("terul"), queried
+
+    counts, before, after, typo, queried = asyncio.run(main())
+    assert counts == {"madrid": 3, "sevilla": 1, "teruel": 1}
+    assert before is None
+    assert after == "teruel"
+    assert typo == "teruel"
+    assert queried == []
@@ -0,0 +1,40 @@
+# tests/test_duplicates.py
+# normalize_url: el mismo anuncio pegado de distintas formas da la misma clave.
+
+import pytest
+
+from fakes import bot_pro
+
+CANONICAL = "idealista.com/inmueble/123"
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.idealista.com/inmueble/123/",
+    "http://idealista.com/inmueble/123",
+    "https://m.idealista.com/inmueble/123",
+    "www.idealista.com/inmueble/123/",
+    "idealista.com/inmueble/123",
+    "idealista.com/inmueble/123/",
+    "IDEALISTA.COM/inmueble/123",
+    "  idealista.com/inmueble/123  ",
+    "idealista.com/inmueble/123/?utm_source=whatsapp&utm_medium=share",
+    "https://www.idealista.com/inmueble/123/?fbclid=abc#fotos",
+])
+def test_same_listing_normalizes_to_the_same_key(url):
+    assert bot_pro.normalize_url(url) == CANONICAL
+
+
+def test_meaningful_query_params_are_kept_and_sorted():
+    assert bot_pro.normalize_url("fotocasa.es/vivienda?id=9&utm_campaign=x&b=2") == "fotocasa.es/vivienda?b=2&id=9"
+
+
+@pytest.mark.parametrize("text", ["", "no", "sin enlace", "3.5", "piso.bonito en el centro", None])
+def test_text_that_is_not_a_link(text):
+    assert bot_pro.normalize_url(text) == ""
+
+
+def test_bare_domain_is_flagged_as_duplicate():
+    index = bot_pro.DuplicateIndex()
+    index.swap(index.build([bot_pro.Listing(url="https://www.idealista.com/inmueble/123/", city="Madrid")]))
+    same = index.same_url(bot_pro.Listing(url="idealista.com/inmueble/123", city="Madrid"))
+    assert same is not None
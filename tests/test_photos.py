@@ -0,0 +1,49 @@
+# tests/test_photos.py
+# PhotoPipeline: las fotos aceptadas y aún sin descargar sobreviven a un reinicio.
+
+import asyncio
+import hashlib
+import os
+import tempfile
+from types import SimpleNamespace
+
+from fakes import bot_pro
+
+
+class PhotoBot:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.downloads = []
+
+    async def get_file(self, file_id):
+        if file_id in self.fail:
+            raise RuntimeError("file not found")
+
+        async def download_as_bytearray():
+            self.downloads.append(file_id)
+            return bytearray(file_id.encode())
+
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+
+def test_pending_photos_resume_after_restart():
+    async def main():
+        tmp = tempfile.mkdtemp()
+        db_path, photo_dir = os.path.join(tmp, "photos.db"), os.path.join(tmp, "uploads")
+        # Se aceptan dos fotos y el proceso muere antes de descargarlas (sin start ni stop)
+        before = bot_pro.PhotoPipeline(bot_pro.PhotoDB(db_path), photo_dir, workers=1, variant_procs=0)
+        await before.enqueue("file-a", "uniq-a")
+        await before.enqueue("file-b", "uniq-b")
+
+        bot = PhotoBot(fail={"file-b"})
+        after = bot_pro.PhotoPipeline(bot_pro.PhotoDB(db_path), photo_dir, workers=1, variant_procs=0)
+        await after.start(bot)
+        await after.stop()
+        left = await after.db._run(lambda: after.db._db().execute("SELECT file_unique_id, attempts FROM photo_jobs").fetchall())
+        sha = hashlib.sha256(b"file-a").hexdigest()
+        return bot.downloads, await after.db.known("uniq-a"), os.path.exists(os.path.join(photo_dir, sha[:2], f"{sha}.jpg")), left
+
+    downloads, known, on_disk, left = asyncio.run(main())
+    assert downloads == ["file-a"]
+    assert known and on_disk
+    assert left == [("uniq-b", 1)]  # la que falló sigue apuntada para el próximo arranque
@@ -0,0 +1,93 @@
+# tests/test_submissions.py
+# SubmissionQueue: parar con un append_rows en curso no duplica filas en la hoja, y una fila que la
+# hoja rechaza siempre se aparta y deja de verse en las búsquedas.
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import gspread
+
+from fakes import FakeBot, FakeWorksheet, bot_pro, fake_values, install, uninstall
+
+
+class SlowSheetCache:
+    # Lo que SubmissionQueue usa de ListingCache. append_rows corre en un hilo y tarda: cancelar la
+    # tarea que lo espera no lo detiene, como pasa con gspread en el pool de SheetStorage.
+    def __init__(self, latency):
+        self.latency = latency
+        self.rows = []
+        self.started = threading.Event()
+        self.storage = SimpleNamespace(breaker=SimpleNamespace(retry_in=lambda: 0.0))
+
+    def _append(self, rows):
+        self.started.set()
+        time.sleep(self.latency)
+        self.rows.extend(rows)
+
+    async def write_rows(self, rows):
+        await asyncio.get_running_loop().run_in_executor(None, self._append, rows)
+
+    def add_pending(self, listing):
+        pass
+
+
+def test_stop_during_flush_does_not_append_twice():
+    async def main():
+        cache = SlowSheetCache(0.5)
+        journal = bot_pro.SubmissionJournal(os.path.join(tempfile.mkdtemp(), "journal.db"))
+        queue = bot_pro.SubmissionQueue(journal, cache, batch=50, interval=0.01, max_backoff=1)
+        await queue.start()
+        await queue.submit(fake_values(1)[1])
+        while not cache.started.is_set():
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return cache.rows, await journal.count()
+
+    rows, left = asyncio.run(main())
+    assert len(rows) == 1
+    assert left == 0
+
+
+class RejectingWorksheet(FakeWorksheet):
+    # La API responde 400 a cualquier lote con una fila de la ciudad "Rechazada"
+    def append_rows(self, rows, **kwargs):
+        if any(r[3] == "Rechazada" for r in rows):
+            body = {"error": {"code": 400, "message": "Invalid value", "status": "INVALID_ARGUMENT"}}
+            raise gspread.exceptions.APIError(SimpleNamespace(status_code=400, headers={}, text="", json=lambda: body))
+        return super().append_rows(rows, **kwargs)
+
+
+def test_rejected_row_is_parked_and_dropped_from_the_cache():
+    async def main():
+        ws = RejectingWorksheet(fake_values(10))
+        await install(ws, FakeBot())
+        queue = bot_pro.SUBMISSIONS
+        queue.interval, queue.max_backoff = 0.01, 0.02
+        try:
+            for i, city in enumerate(["Soria", "Rechazada", "Teruel"]):
+                row = fake_values(1, seed=i)[1]
+                row[3], row[8] = city, f"https://example.com/piso/{i}"
+                await queue.submit(row)
+            assert [l.city for l in await bot_pro.LISTINGS.by_city("Rechazada", 5)] == ["Rechazada"]
+            for _ in range(200):
+                if not await queue.journal.count():
+                    break
+                await asyncio.sleep(0.01)
+            return (
+                [r[3] for r in ws.values[11:]],
+                await bot_pro.LISTINGS.by_city("Rechazada", 5),
+                [l.city for l in await bot_pro.LISTINGS.by_city("Teruel", 5)],
+                "rechazada" in bot_pro.MARKET.by_city,
+            )
+        finally:
+            await uninstall()
+
+    sheet, rejected, others, in_stats = asyncio.run(main())
+    assert sheet == ["Soria", "Teruel"]
+    assert rejected == []
+    assert others == ["Teruel"]
+    assert not in_stats